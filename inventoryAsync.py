@@ -0,0 +1,115 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import inventoryDB as iDB
+
+# Public functions that only read -> run concurrently on the reader pool, everything else goes through the writer queue
+READ_FUNCTIONS = {"findProductByName", "fetchReviews", "getVariantRating", "getVariantRatings", "getVariantRatingHistogram", "getProductRatings",
+                  "getPriceAt", "getPricesAt", "getLocation", "getVariant", "fetchOrder", "fetchStockAlerts",
+                  "searchCatalog", "checkAvailability", "movementAnalytics", "unitsSoldByCategory", "netInflowByLocation"}
+# Public functions that are not wrapped in wrap_transaction but still belong in the facade
+EXTRA_FUNCTIONS = ("addMovements", "compactMovements")
+
+# Asyncio facade over the public inventoryDB API. Every public function is exposed as a coroutine
+# with the same arguments minus conn, plus an optional timeout in seconds:
+#
+#   async with AsyncInventory('inventory.db') as inventory:
+#       await inventory.addMovementOut(variant, location, amount, reason, status)
+#       rating = await inventory.getVariantRating(variant, timeout = 2)
+#
+# Reads run on a bounded pool of threads, each with its own read-only connection. Writes are queued
+# onto a single thread holding the writer connection, so they never contend with each other.
+# Cancelling a call (or hitting its timeout) interrupts the statement that is running for it, and any statement it
+# starts afterwards. Chunked writers (addMovements, compactMovements) commit chunk by chunk, so cancelling one stops it
+# at the chunk in progress but leaves the chunks committed before it in place.
+class AsyncInventory:
+    def __init__(self, path = 'inventory.db', max_readers = 4, manager = None, **pragmas):
+        self._owns_manager = manager is None
+        self.manager = manager or iDB.ConnectionManager(path, **pragmas)
+        self._reader_pool = ThreadPoolExecutor(max_workers = max_readers, thread_name_prefix = "inventory-read")
+        self._writer_queue = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "inventory-write")
+
+    async def _call(self, func, args, kwargs, write, timeout):
+        loop = asyncio.get_running_loop()
+        job = _Job(self.manager, func, args, kwargs, write)
+        future = loop.run_in_executor(self._writer_queue if write else self._reader_pool, job.run)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            # A queued job is dropped by the executor, a running one is interrupted inside SQLite
+            job.interrupt()
+            raise
+
+    def close(self):
+        self._reader_pool.shutdown(wait = True, cancel_futures = True)
+        self._writer_queue.shutdown(wait = True, cancel_futures = True)
+        if self._owns_manager:
+            self.manager.close()
+
+    async def aclose(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+# One call of a public function on a worker thread, remembering which connection it runs on so it can be interrupted
+class _Job:
+    def __init__(self, manager, func, args, kwargs, write):
+        self.manager = manager
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.write = write
+        self._conn = None
+        self._cancelled = False
+        self._lock = threading.Lock()
+
+    def run(self):
+        if self.write:
+            with self.manager.writer() as conn:
+                return self._runOn(conn)
+        return self._runOn(self.manager.reader())
+
+    def _runOn(self, conn):
+        with self._lock:
+            if self._cancelled:
+                raise asyncio.CancelledError()
+            self._conn = conn
+        # Catches a cancellation that lands between two statements, which conn.interrupt() alone would miss
+        iDB.addProgressHandler(conn, self._isCancelled)
+        try:
+            return self.func(conn, *self.args, **self.kwargs)
+        finally:
+            iDB.removeProgressHandler(conn, self._isCancelled)
+            with self._lock:
+                self._conn = None
+
+    def _isCancelled(self):
+        return self._cancelled
+
+    def interrupt(self):
+        with self._lock:
+            self._cancelled = True
+            if self._conn is not None:
+                self._conn.interrupt()
+
+def _makeMethod(name, func, write):
+    async def method(self, *args, timeout = None, **kwargs):
+        return await self._call(func, args, kwargs, write, timeout)
+    method.__name__ = name
+    method.__qualname__ = "AsyncInventory." + name
+    method.__doc__ = func.__doc__
+    return method
+
+def _publicFunctions():
+    for name in dir(iDB):
+        func = getattr(iDB, name)
+        if getattr(func, "transactional", False) or name in EXTRA_FUNCTIONS:
+            yield name, func
+
+for _name, _func in _publicFunctions():
+    setattr(AsyncInventory, _name, _makeMethod(_name, _func, _name not in READ_FUNCTIONS))
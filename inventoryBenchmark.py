@@ -0,0 +1,230 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+from datetime import datetime, timedelta
+from time import perf_counter
+
+import inventoryDB as iDB
+import inventoryTest as test
+
+# Reproducible benchmark suite. A seeded generator builds a synthetic catalog and ledger on top of the
+# inventoryTest.populate() fixture, then the key operations are timed through the public API and the
+# results are written as JSON so runs can be compared between releases.
+#
+#   python inventoryBenchmark.py --scale large --output bench.json
+
+SCALES = {
+    "tiny" : {"products" : 200, "variants" : 1000, "locations" : 20, "movements" : 20000, "reviews" : 20000, "prices" : 2},
+    "small" : {"products" : 2000, "variants" : 10000, "locations" : 100, "movements" : 500000, "reviews" : 500000, "prices" : 3},
+    "large" : {"products" : 20000, "variants" : 100000, "locations" : 1000, "movements" : 10000000, "reviews" : 10000000, "prices" : 5},
+}
+CATEGORIES = ["Footwear", "Jackets", "Sports accessories", "Trousers", "Shirts", "Bags", "Hats", "Socks"]
+WORDS = ["comfortable", "great", "small", "large", "colour", "quality", "cheap", "durable", "soft", "perfect", "broken", "fast"]
+GENERATION_CHUNK = 50000
+LEDGER_START = datetime(2024, 1, 1)
+LEDGER_DAYS = 730
+
+#### Synthetic data generation--------------------------------------------------
+def _chunks(rows, size = GENERATION_CHUNK):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _insertChunks(conn, sql, rows):
+    cursor = conn.cursor()
+    for chunk in _chunks(rows):
+        cursor.executemany(sql, chunk)
+        conn.commit()
+
+def _timestamp(rng):
+    return (LEDGER_START + timedelta(seconds = rng.randrange(LEDGER_DAYS * 86400))).strftime('%Y-%m-%d %H:%M:%S')
+
+def generate(conn, scale, seed):
+    rng = random.Random(seed)
+    test.populate(conn)
+    cursor = conn.cursor()
+    cursor.execute("SELECT IFNULL(MAX(id), 0) FROM products")
+    first_product = cursor.fetchone()[0] + 1
+    cursor.execute("SELECT IFNULL(MAX(id), 0) FROM variants")
+    first_variant = cursor.fetchone()[0] + 1
+    cursor.execute("SELECT IFNULL(MAX(id), 0) FROM locations")
+    first_location = cursor.fetchone()[0] + 1
+
+    products = range(first_product, first_product + scale["products"])
+    variants = range(first_variant, first_variant + scale["variants"])
+    locations = range(first_location, first_location + scale["locations"])
+
+    _insertChunks(conn, "INSERT INTO products (id, name, category) VALUES (?, ?, ?)",
+                  ((product, "Product {}".format(product), rng.choice(CATEGORIES)) for product in products))
+    _insertChunks(conn, "INSERT INTO variants (id, product_id, description, current_price) VALUES (?, ?, ?, ?)",
+                  ((variant, rng.choice(products), "Variant {}".format(variant), rng.randrange(5, 500)) for variant in variants))
+    _insertChunks(conn, "INSERT INTO locations (id, location_name, is_storage, address) VALUES (?, ?, ?, ?)",
+                  ((location, "Location {}".format(location), location % 10 == 0, "") for location in locations))
+    _insertChunks(conn, "INSERT INTO price_history (variant_id, price, start_date) VALUES (?, ?, ?)",
+                  ((variant, rng.randrange(5, 500), _timestamp(rng)) for variant in variants for _ in range(scale["prices"])))
+    _insertChunks(conn, "INSERT INTO reviews (variant_id, body, user_name, rating, created_at) VALUES (?, ?, ?, ?, ?)",
+                  ((rng.choice(variants), " ".join(rng.choices(WORDS, k = 6)), "user{}".format(rng.randrange(100000)), rng.randint(1, 5), _timestamp(rng))
+                   for _ in range(scale["reviews"])))
+    _insertChunks(conn, "INSERT INTO stock_movements (variant_id, location_id, source_location_id, change_amount, type, reason, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                  _generateMovements(rng, variants, locations, scale["movements"]))
+
+    # Raw ledger rows bypass has_variants, so every pair they touch gets its row before the amounts are recalculated
+    cursor.execute("""INSERT INTO has_variants (variant_id, location_id)
+                   SELECT variant_id, location_id FROM stock_movements
+                   UNION SELECT variant_id, source_location_id FROM stock_movements WHERE source_location_id IS NOT NULL
+                   ON CONFLICT (variant_id, location_id) DO NOTHING""")
+    conn.commit()
+
+    # Derived state is rebuilt the same way an existing database would be
+    iDB.rebuildVariantRatings(conn)
+    iDB.rebuildSearchIndex(conn)
+    iDB.recalculateAllPhysicalAmounts(conn)
+    iDB.reconcileReservedAmounts(conn)
+    iDB.rebuildMovementRollups(conn)
+
+def _generateMovements(rng, variants, locations, count):
+    # Timestamps are generated in order so ids and created_at grow together like a real ledger
+    step = LEDGER_DAYS * 86400 / max(count, 1)
+    for index in range(count):
+        created_at = (LEDGER_START + timedelta(seconds = int(index * step))).strftime('%Y-%m-%d %H:%M:%S')
+        variant = rng.choice(variants)
+        location = rng.choice(locations)
+        roll = rng.random()
+        if roll < 0.45:
+            yield (variant, location, None, rng.randint(10, 100), "IN", "RESTOCK", "COMPLETED", created_at)
+        elif roll < 0.90:
+            yield (variant, location, None, rng.randint(1, 5), "OUT", "SALE", "COMPLETED" if rng.random() < 0.95 else "PENDING", created_at)
+        elif roll < 0.98:
+            yield (variant, location, rng.choice(locations), rng.randint(1, 20), "TRANSFER", "INTERNAL", "COMPLETED", created_at)
+        else:
+            yield (variant, location, None, rng.randint(0, 50), "ADJUST", "CORRECTION", "COMPLETED", created_at)
+
+#### Timing----------------------------------------------------------------------
+def _percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def _timeOperation(operation, iterations, units_per_iteration = 1):
+    samples = []
+    for index in range(iterations):
+        start = perf_counter()
+        operation(index)
+        samples.append(perf_counter() - start)
+    total = sum(samples)
+    return {
+        "iterations" : iterations,
+        "total_seconds" : total,
+        "ops_per_second" : iterations * units_per_iteration / total if total else None,
+        "mean_ms" : statistics.mean(samples) * 1000,
+        "p50_ms" : _percentile(samples, 0.50) * 1000,
+        "p95_ms" : _percentile(samples, 0.95) * 1000,
+        "max_ms" : max(samples) * 1000,
+    }
+
+def runBenchmarks(conn, seed, iterations = 200):
+    rng = random.Random(seed + 1)
+    cursor = conn.cursor()
+    cursor.execute("SELECT variant_id, location_id FROM has_variants")
+    pairs = cursor.fetchall()
+    cursor.execute("SELECT id FROM variants")
+    variants = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT id FROM locations")
+    locations = [row[0] for row in cursor.fetchall()]
+
+    def movement(index):
+        variant, location = rng.choice(pairs)
+        if index % 2:
+            return {"variant" : variant, "location" : location, "amount" : 1, "type" : iDB.MovementType.OUT, "reason" : iDB.MovementOutReason.SALE}
+        return {"variant" : variant, "location" : location, "amount" : 1, "type" : iDB.MovementType.IN, "reason" : iDB.MovementInReason.RESTOCK, "status" : iDB.MovementStatus.COMPLETED}
+
+    batch_size = 1000
+    results = {}
+    results["movement_insert_single"] = _timeOperation(
+        lambda index: iDB.addMovementIn(conn, *rng.choice(pairs), 1, iDB.MovementInReason.RESTOCK, iDB.MovementStatus.COMPLETED), iterations)
+    results["movement_insert_bulk"] = _timeOperation(
+        lambda index: iDB.addMovements(conn, (movement(row) for row in range(batch_size)), chunk_size = batch_size), max(iterations // 20, 1), batch_size)
+    results["inventory_summary_full_scan"] = _timeOperation(
+        lambda index: sum(1 for row in iDB.iterInventorySummary(conn, page_size = 5000)), 3)
+    results["inventory_summary_point_lookup"] = _timeOperation(
+        lambda index: cursor.execute("SELECT * FROM v_inventory_summary WHERE variant_id = ? AND location_id = ?", rng.choice(pairs)).fetchall(), iterations)
+    results["variant_rating"] = _timeOperation(
+        lambda index: iDB.getVariantRating(conn, rng.choice(variants)), iterations)
+    results["variant_ratings_page_of_50"] = _timeOperation(
+        lambda index: iDB.getVariantRatings(conn, rng.sample(variants, 50)), iterations, 50)
+    results["catalog_search"] = _timeOperation(
+        lambda index: iDB.searchCatalog(conn, " ".join(rng.sample(WORDS, 2))[:rng.randint(3, 8)]), iterations)
+    results["price_insert"] = _timeOperation(
+        lambda index: iDB.addPrice(conn, rng.choice(variants), rng.randrange(5, 500)), iterations)
+    results["price_as_of"] = _timeOperation(
+        lambda index: iDB.getPriceAt(conn, rng.choice(variants), _timestamp(rng)), iterations)
+    results["units_sold_by_category_30_days"] = _timeOperation(
+        lambda index: iDB.unitsSoldByCategory(conn, LEDGER_START + timedelta(days = index % (LEDGER_DAYS - 30)), LEDGER_START + timedelta(days = index % (LEDGER_DAYS - 30) + 30)), iterations)
+    results["recalculate_physical_amount"] = _timeOperation(
+        lambda index: iDB.recalculatePhysicalAmount(conn, *rng.choice(pairs)), iterations)
+    results["recalculate_all_physical_amounts"] = _timeOperation(
+        lambda index: iDB.recalculateAllPhysicalAmounts(conn), 1)
+    return results
+
+def _datasetCounts(conn):
+    cursor = conn.cursor()
+    counts = {}
+    for table in ("products", "variants", "locations", "has_variants", "stock_movements", "reviews", "price_history"):
+        cursor.execute("SELECT COUNT(*) FROM {}".format(table))
+        counts[table] = cursor.fetchone()[0]
+    return counts
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Inventory Manager benchmark suite")
+    parser.add_argument("--scale", choices = sorted(SCALES), default = "tiny", help = "Size of the synthetic dataset")
+    parser.add_argument("--seed", type = int, default = 42, help = "Seed for the synthetic data and the operation mix")
+    parser.add_argument("--iterations", type = int, default = 200, help = "Timed iterations per operation")
+    parser.add_argument("--db", default = "benchmark.db", help = "Database file to build the dataset in")
+    parser.add_argument("--reuse", action = "store_true", help = "Reuse an existing --db instead of regenerating it")
+    parser.add_argument("--output", help = "Write the JSON results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    if not args.reuse:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+    conn = iDB.initDatabase(args.db)
+    generation_seconds = None
+    if not args.reuse:
+        start = perf_counter()
+        generate(conn, SCALES[args.scale], args.seed)
+        generation_seconds = perf_counter() - start
+
+    report = {
+        "meta" : {
+            "scale" : args.scale,
+            "seed" : args.seed,
+            "iterations" : args.iterations,
+            "started_at" : datetime.now().isoformat(timespec = "seconds"),
+            "python" : platform.python_version(),
+            "sqlite" : sqlite3.sqlite_version,
+            "platform" : platform.platform(),
+        },
+        "dataset" : dict(_datasetCounts(conn), generation_seconds = generation_seconds),
+        "results" : runBenchmarks(conn, args.seed, args.iterations),
+    }
+    conn.close()
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent = 2)
+    else:
+        json.dump(report, sys.stdout, indent = 2)
+        print()
+
+if __name__ == "__main__":
+    main()
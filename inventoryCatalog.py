@@ -0,0 +1,176 @@
+import csv
+import json
+import os
+from contextlib import contextmanager
+from itertools import islice
+
+import inventoryDB as iDB
+
+# Streaming catalog import/export. Imports read CSV or JSON Lines in chunks, stage every chunk in a temp table and
+# upsert products, variants, prices and locations with set-based SQL, committing once per chunk. Exports write
+# straight from the cursor. Memory is bounded by chunk_size either way.
+#
+# Import records have the fields product_name, category, description, price and optionally location_name,
+# is_storage, address (the variant is then stocked at that location). Products are matched by name, variants by
+# (product, description) and locations by name; a price is only recorded when it differs from the current one.
+
+SUMMARY_FIELDS = list(iDB.InventoryRow._fields)
+MOVEMENT_FIELDS = ["id", "variant_id", "location_id", "source_location_id", "change_amount", "type", "reason", "status", "created_at", "order_id"]
+
+#### Import-----------------------------------------------------------------------
+def importCatalog(conn, source, format = None, chunk_size = 5000):
+    report = {"rows" : 0, "products_created" : 0, "variants_created" : 0, "prices_added" : 0, "locations_created" : 0}
+    with _openStream(source, "r") as (stream, name):
+        records = _readRecords(stream, format or _formatFromName(name))
+        _createStagingTable(conn)
+        try:
+            while True:
+                chunk = list(islice(records, chunk_size))
+                if not chunk:
+                    break
+                _importChunkLogic(conn, chunk, report, report["rows"])
+                conn.commit()
+                report["rows"] += len(chunk)
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            iDB.clearLookupCache()
+    return report
+
+def _createStagingTable(conn):
+    conn.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS catalog_staging (
+                row_number INTEGER PRIMARY KEY,
+                product_name VARCHAR(255) NOT NULL,
+                category VARCHAR(50),
+                description TEXT,
+                price INTEGER,
+                location_name VARCHAR(50),
+                is_storage BOOLEAN,
+                address VARCHAR(255),
+                product_id INTEGER,
+                variant_id INTEGER,
+                location_id INTEGER)
+                ''')
+
+def _importChunkLogic(conn, chunk, report, first_row):
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM catalog_staging")
+    cursor.executemany("INSERT INTO catalog_staging (row_number, product_name, category, description, price, location_name, is_storage, address) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (_stagingRow(first_row + index, record) for index, record in enumerate(chunk)))
+
+    # Products -> create the missing ones, refresh categories, then resolve ids
+    cursor.execute("""INSERT INTO products (name, category)
+                   SELECT s.product_name, s.category FROM catalog_staging s
+                   WHERE s.row_number IN (SELECT MAX(row_number) FROM catalog_staging GROUP BY product_name)
+                   AND NOT EXISTS (SELECT 1 FROM products p WHERE p.name = s.product_name)
+                   ORDER BY s.row_number""")
+    report["products_created"] += cursor.rowcount
+    cursor.execute("UPDATE catalog_staging SET product_id = (SELECT MIN(p.id) FROM products p WHERE p.name = catalog_staging.product_name)")
+    cursor.execute("""UPDATE products SET category = (
+                       SELECT s.category FROM catalog_staging s WHERE s.product_id = products.id AND s.category IS NOT NULL ORDER BY s.row_number DESC LIMIT 1)
+                   WHERE id IN (SELECT product_id FROM catalog_staging WHERE category IS NOT NULL)""")
+
+    # Variants -> create the missing (product, description) pairs, then resolve ids
+    cursor.execute("""INSERT INTO variants (product_id, description)
+                   SELECT s.product_id, s.description FROM catalog_staging s
+                   WHERE s.row_number IN (SELECT MIN(row_number) FROM catalog_staging GROUP BY product_id, description)
+                   AND NOT EXISTS (SELECT 1 FROM variants v WHERE v.product_id = s.product_id AND v.description IS s.description)
+                   ORDER BY s.row_number""")
+    report["variants_created"] += cursor.rowcount
+    cursor.execute("""UPDATE catalog_staging SET variant_id = (
+                       SELECT MIN(v.id) FROM variants v WHERE v.product_id = catalog_staging.product_id AND v.description IS catalog_staging.description)""")
+    # Search index -> new variants, and every variant of a product whose category may have changed
+    cursor.execute("SELECT id FROM variants WHERE product_id IN (SELECT product_id FROM catalog_staging)")
+    iDB._indexVariantsLogic(conn, [row[0] for row in cursor.fetchall()])
+
+    # Prices -> the last price given for a variant wins, and is only recorded when it changes the current price
+    cursor.execute("""INSERT INTO price_history (variant_id, price)
+                   SELECT s.variant_id, s.price FROM catalog_staging s JOIN variants v ON v.id = s.variant_id
+                   WHERE s.row_number IN (SELECT MAX(row_number) FROM catalog_staging WHERE price IS NOT NULL GROUP BY variant_id)
+                   AND v.current_price IS NOT s.price""")
+    report["prices_added"] += cursor.rowcount
+    cursor.execute("""UPDATE variants SET current_price = (
+                       SELECT s.price FROM catalog_staging s WHERE s.variant_id = variants.id AND s.price IS NOT NULL ORDER BY s.row_number DESC LIMIT 1)
+                   WHERE id IN (SELECT variant_id FROM catalog_staging WHERE price IS NOT NULL)""")
+
+    # Locations -> create the missing ones and stock the variants there
+    cursor.execute("""INSERT INTO locations (location_name, is_storage, address)
+                   SELECT s.location_name, IFNULL(s.is_storage, 0), IFNULL(s.address, '') FROM catalog_staging s
+                   WHERE s.row_number IN (SELECT MIN(row_number) FROM catalog_staging WHERE location_name IS NOT NULL GROUP BY location_name)
+                   AND NOT EXISTS (SELECT 1 FROM locations l WHERE l.location_name = s.location_name)
+                   ORDER BY s.row_number""")
+    report["locations_created"] += cursor.rowcount
+    cursor.execute("""UPDATE catalog_staging SET location_id = (SELECT MIN(l.id) FROM locations l WHERE l.location_name = catalog_staging.location_name)
+                   WHERE location_name IS NOT NULL""")
+    cursor.execute("""INSERT INTO has_variants (variant_id, location_id)
+                   SELECT DISTINCT variant_id, location_id FROM catalog_staging WHERE location_id IS NOT NULL
+                   ON CONFLICT (variant_id, location_id) DO NOTHING""")
+
+def _stagingRow(row_number, record):
+    if not record.get("product_name"):
+        raise ValueError("Catalog row {} has no product_name".format(row_number + 1))
+    price = record.get("price")
+    is_storage = record.get("is_storage")
+    if isinstance(is_storage, str):
+        is_storage = is_storage.strip().lower() in ("1", "true", "yes", "y") if is_storage.strip() else None
+    return (row_number, record["product_name"], record.get("category") or None, record.get("description") or None,
+            int(price) if price not in (None, "") else None, record.get("location_name") or None, is_storage, record.get("address") or None)
+
+#### Export-----------------------------------------------------------------------
+def exportInventorySummary(conn, destination, format = None, location = None):
+    query = "SELECT " + ", ".join(SUMMARY_FIELDS) + " FROM v_inventory_summary"
+    params = ()
+    if location is not None:
+        query += " WHERE location_id = ?"
+        params = (location,)
+    _export(conn, destination, format, query + " ORDER BY variant_id, location_id", params, SUMMARY_FIELDS)
+
+def exportMovements(conn, destination, format = None, since = None):
+    query = "SELECT " + ", ".join(MOVEMENT_FIELDS) + " FROM stock_movements"
+    params = ()
+    if since is not None:
+        query += " WHERE created_at >= ?"
+        params = (iDB._formatTimestamp(since),)
+    _export(conn, destination, format, query + " ORDER BY id", params, MOVEMENT_FIELDS)
+
+def _export(conn, destination, format, query, params, fields):
+    with _openStream(destination, "w") as (stream, name):
+        format = format or _formatFromName(name)
+        cursor = conn.cursor()
+        cursor.arraysize = 1000
+        cursor.execute(query, params)
+        if format == "csv":
+            writer = csv.writer(stream)
+            writer.writerow(fields)
+            writer.writerows(cursor)
+        else:
+            for row in cursor:
+                stream.write(json.dumps(dict(zip(fields, row))))
+                stream.write("\n")
+
+#### Helpers----------------------------------------------------------------------
+def _formatFromName(name):
+    extension = os.path.splitext(name or "")[1].lower()
+    if extension in (".jsonl", ".ndjson"):
+        return "jsonl"
+    if extension == ".csv":
+        return "csv"
+    raise ValueError("Cannot tell the format of {!r}, pass format='csv' or format='jsonl'".format(name))
+
+def _readRecords(stream, format):
+    if format == "csv":
+        return iter(csv.DictReader(stream))
+    if format == "jsonl":
+        return (json.loads(line) for line in stream if line.strip())
+    raise ValueError("Unsupported catalog format: {}".format(format))
+
+@contextmanager
+def _openStream(source, mode):
+    # Accepts a path or an already open file, only closing what it opened
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, mode, newline = "", encoding = "utf-8") as stream:
+            yield stream, os.fspath(source)
+    else:
+        yield source, getattr(source, "name", None)
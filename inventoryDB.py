@@ -1,7 +1,16 @@
+import json
+import logging
+import re
 import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 from functools import wraps
 from enum import Enum
+from collections import namedtuple, OrderedDict
+from time import perf_counter
+
+import inventoryMetrics
 
 class MovementType(Enum):
     IN = 0
@@ -9,14 +18,17 @@ class MovementType(Enum):
     TRANSFER = 2
     ADJUST = 3
 
+# TRANSFER in/out reasons record the two halves of a transfer between location shards (see inventoryShards)
 class MovementInReason(Enum):
     RESTOCK = 0
     RETURN = 1
+    TRANSFER = 2
 
 class MovementOutReason(Enum):
     SALE = 0
     DAMAGE = 1
     DISPOSAL = 2
+    TRANSFER = 3
 
 class MovementTransferReason(Enum):
     INTERNAL = 0
@@ -30,142 +42,696 @@ class MovementStatus(Enum):
     CANCELLED = 2
     IN_TRANSIT = 3
 
+# Enums are stored by name (e.g. 'OUT', 'PENDING') so they can be bound directly as query parameters
+for _enum in (MovementType, MovementInReason, MovementOutReason, MovementTransferReason, MovementAdjustReason, MovementStatus):
+    sqlite3.register_adapter(_enum, lambda member: member.name)
 
-def initDatabase():
-    conn = sqlite3.connect('inventory.db')
-    conn.execute("PRAGMA foreign_keys = ON;")
+# Valid reasons and the default status for every movement type
+MOVEMENT_REASONS = {
+    MovementType.IN : MovementInReason,
+    MovementType.OUT : MovementOutReason,
+    MovementType.TRANSFER : MovementTransferReason,
+    MovementType.ADJUST : MovementAdjustReason,
+}
+MOVEMENT_DEFAULT_STATUS = {
+    MovementType.IN : MovementStatus.PENDING,
+    MovementType.OUT : MovementStatus.COMPLETED,
+    MovementType.TRANSFER : MovementStatus.IN_TRANSIT,
+    MovementType.ADJUST : MovementStatus.COMPLETED,
+}
+
+# Raised when an order asks for more than is available -> lines lists {"variant", "location", "requested", "available"} for every short line
+class InsufficientStockError(Exception):
+    def __init__(self, lines):
+        super().__init__("Insufficient stock for {} line(s): {}".format(len(lines), lines))
+        self.lines = lines
+
+# Lightweight row types yielded by the streaming readers and returned by searchCatalog
+Review = namedtuple("Review", ["id", "variant_id", "body", "user_name", "rating", "created_at"])
+Movement = namedtuple("Movement", ["id", "variant_id", "location_id", "source_location_id", "amount", "type", "reason", "status", "created_at"])
+SearchResult = namedtuple("SearchResult", ["variant_id", "product_name", "category", "description", "current_price", "available_amount", "score"])
+InventoryRow = namedtuple("InventoryRow", ["variant_id", "product_name", "description", "current_price", "location_id", "location_name", "physical_amount", "reserved_amount", "available_amount"])
+
+def initDatabase(path = 'inventory.db', **pragmas):
+    conn = sqlite3.connect(path, check_same_thread = False)
+    configureConnection(conn, **pragmas)
     cursor = conn.cursor()
     try:
         cursor.execute("BEGIN;")
-        cursor.execute('''
-                CREATE TABLE IF NOT EXISTS products (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name VARCHAR(255),
-                    category VARCHAR(50))
-                    ''')
-        cursor.execute('''
-                CREATE TABLE IF NOT EXISTS variants (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    product_id INTEGER NOT NULL,
-                    description TEXT,
-                    current_price INTEGER DEFAULT 0,
-                    
-                    FOREIGN KEY (product_id) REFERENCES products (id) )
-                    ''')
-        cursor.execute('''
-                CREATE TABLE IF NOT EXISTS price_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    variant_id INTEGER NOT NULL,
-                    price INTEGER NOT NULL,
-                    start_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        
-                    FOREIGN KEY (variant_id) REFERENCES variants (id))
-                    ''')
-        cursor.execute('''
-                CREATE TABLE IF NOT EXISTS reviews (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    variant_id INTEGER NOT NULL,
-                    body TEXT,
-                    user_name VARCHAR(50),
-                    rating INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                       
-                    FOREIGN KEY (variant_id) REFERENCES variants (id))
-                    ''')
-        cursor.execute('''
-                CREATE TABLE IF NOT EXISTS locations (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    location_name VARCHAR(50) NOT NULL,
-                    is_storage BOOLEAN NOT NULL,
-                    address VARCHAR(255)
-                    )
-                    ''')
-        cursor.execute('''
-                CREATE TABLE IF NOT EXISTS has_variants (
-                    variant_id INTEGER NOT NULL,
-                    location_id INTEGER NOT NULL,
-                    physical_amount INTEGER DEFAULT 0,
-                       
-                    FOREIGN KEY (variant_id) REFERENCES variants(id),
-                    FOREIGN KEY (location_id) REFERENCES locations(id)
-                    )
-                    ''')
-        cursor.execute('''
-                CREATE TABLE IF NOT EXISTS stock_movements (
-                    variant_id INTEGER NOT NULL,
-                    location_id INTEGER NOT NULL,
-                    source_location_id INTEGER
-                    change_amount INTEGER DEFAULT 0,
-                    type VARCHAR(50),
-                    status VARCHAR(50),
-                    reason VARCHAR(50),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                       
-                    FOREIGN KEY (variant_id) REFERENCES variants(id),
-                    FOREIGN KEY (location_id) REFERENCES locations(id),
-                    FOREIGN KEY (source_location_id) REFERENCES locations(id)
-                    )
-                    ''')
-        cursor.execute('''
-                CREATE VIEW IF NOT EXISTS v_inventory_summary AS
-                SELECT
-                    v.id AS variant_id,
-                    p.name AS product_name,
-                    v.description AS description,
-                    v.current_price as current_price,
-                    l.id AS location_id,
-                    l.location_name AS location_name,
-                    h.physical_amount AS physical_amount,
-                    
-                    h.physical_amount - IFNULL((
-                        SELECT SUM(m.change_amount)
-                        FROM stock_movements m
-                        WHERE m.variant_id = h.variant_id
-                        AND m.location_id = h.location_id
-                        AND m.type = 'OUT'
-                        AND m.status = 'Pending'
-
-                       ), 0) AS available_amount
-
-                FROM variants v
-                JOIN products p ON v.product_id = p.id
-                JOIN has_variants h ON v.id = h.variant_id
-                JOIN locations l ON h.location_id = l.id;
-
-                    ''')
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_variant_product_id ON variants(product_id);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_product_name ON products(name);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_review_variant ON reviews(variant_id);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_has_products_logic ON has_variants(variant_id, location_id);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_movement_logic ON stock_movements(variant_id, location_id, type, status);")
-        
+        _createCatalogSchemaLogic(conn)
+        _createStockSchemaLogic(conn)
+        _createSummaryViewLogic(conn)
         conn.commit()
         return conn
     except sqlite3.Error as e:
         conn.rollback()
         raise e
 
+# The schema is split in two so the catalog and the stock tables can also live in separate files (see inventoryShards)
+# Catalog -> products, variants, prices, reviews and locations
+def _createCatalogSchemaLogic(conn):
+    cursor = conn.cursor()
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS products (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name VARCHAR(255),
+                category VARCHAR(50))
+                ''')
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS variants (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                product_id INTEGER NOT NULL,
+                description TEXT,
+                current_price INTEGER DEFAULT 0,
+                
+                FOREIGN KEY (product_id) REFERENCES products (id) )
+                ''')
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS price_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                variant_id INTEGER NOT NULL,
+                price INTEGER NOT NULL,
+                start_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    
+                FOREIGN KEY (variant_id) REFERENCES variants (id))
+                ''')
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS reviews (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                variant_id INTEGER NOT NULL,
+                body TEXT,
+                user_name VARCHAR(50),
+                rating INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                   
+                FOREIGN KEY (variant_id) REFERENCES variants (id))
+                ''')
+    ratings_exist = _tableExists(cursor, "variant_ratings")
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS variant_ratings (
+                variant_id INTEGER PRIMARY KEY,
+                review_count INTEGER NOT NULL DEFAULT 0,
+                rating_sum INTEGER NOT NULL DEFAULT 0,
+                stars_1 INTEGER NOT NULL DEFAULT 0,
+                stars_2 INTEGER NOT NULL DEFAULT 0,
+                stars_3 INTEGER NOT NULL DEFAULT 0,
+                stars_4 INTEGER NOT NULL DEFAULT 0,
+                stars_5 INTEGER NOT NULL DEFAULT 0,
+
+                FOREIGN KEY (variant_id) REFERENCES variants (id))
+                ''')
+    # Databases created before the aggregates existed get them built from the reviews once
+    if not ratings_exist:
+        _rebuildVariantRatingsLogic(conn)
+    # Full-text index -> one row per variant (rowid = - variant id) and one per review (rowid = review id)
+    search_exists = _tableExists(cursor, "search_index")
+    cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5 (
+                name,
+                category,
+                description,
+                review,
+                variant_id UNINDEXED,
+                tokenize = 'unicode61 remove_diacritics 2',
+                prefix = '2 3')
+                ''')
+    if not search_exists:
+        _rebuildSearchIndexLogic(conn)
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS locations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                location_name VARCHAR(50) NOT NULL,
+                is_storage BOOLEAN NOT NULL,
+                address VARCHAR(255)
+                )
+                ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_variant_product_id ON variants(product_id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_product_name ON products(name);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_location_name ON locations(location_name);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_review_variant ON reviews(variant_id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_price_history_asof ON price_history(variant_id, start_date);")
+
+# Stock -> stock levels, the movement ledger and everything derived from it
+def _createStockSchemaLogic(conn):
+    cursor = conn.cursor()
+    ledger_rebuilt = _migrateBaselineStockSchemaLogic(cursor)
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS has_variants (
+                variant_id INTEGER NOT NULL,
+                location_id INTEGER NOT NULL,
+                physical_amount INTEGER DEFAULT 0,
+                reserved_amount INTEGER DEFAULT 0,
+                   
+                FOREIGN KEY (variant_id) REFERENCES variants(id),
+                FOREIGN KEY (location_id) REFERENCES locations(id)
+                )
+                ''')
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stock_baselines (
+                variant_id INTEGER NOT NULL,
+                location_id INTEGER NOT NULL,
+                last_movement_id INTEGER NOT NULL,
+                amount INTEGER NOT NULL,
+
+                PRIMARY KEY (variant_id, location_id),
+                FOREIGN KEY (variant_id) REFERENCES variants(id),
+                FOREIGN KEY (location_id) REFERENCES locations(id)
+                )
+                ''')
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stock_movement_summaries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                period_type VARCHAR(10) NOT NULL,
+                period VARCHAR(10) NOT NULL,
+                variant_id INTEGER NOT NULL,
+                location_id INTEGER NOT NULL,
+                source_location_id INTEGER,
+                type VARCHAR(50),
+                status VARCHAR(50),
+                reason VARCHAR(50),
+                movement_count INTEGER NOT NULL,
+                total_amount INTEGER NOT NULL,
+                first_movement_id INTEGER NOT NULL,
+                last_movement_id INTEGER NOT NULL,
+                compacted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+                FOREIGN KEY (variant_id) REFERENCES variants(id),
+                FOREIGN KEY (location_id) REFERENCES locations(id)
+                )
+                ''')
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stock_snapshots (
+                variant_id INTEGER NOT NULL,
+                location_id INTEGER NOT NULL,
+                last_movement_id INTEGER NOT NULL,
+                amount INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+                PRIMARY KEY (variant_id, location_id),
+                FOREIGN KEY (variant_id) REFERENCES variants(id),
+                FOREIGN KEY (location_id) REFERENCES locations(id)
+                )
+                ''')
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stock_movements (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                variant_id INTEGER NOT NULL,
+                location_id INTEGER NOT NULL,
+                source_location_id INTEGER,
+                change_amount INTEGER DEFAULT 0,
+                type VARCHAR(50),
+                status VARCHAR(50),
+                reason VARCHAR(50),
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                order_id INTEGER,
+                   
+                FOREIGN KEY (variant_id) REFERENCES variants(id),
+                FOREIGN KEY (location_id) REFERENCES locations(id),
+                FOREIGN KEY (source_location_id) REFERENCES locations(id),
+                FOREIGN KEY (order_id) REFERENCES movement_orders(id)
+                )
+                ''')
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS movement_orders (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                type VARCHAR(50) NOT NULL,
+                status VARCHAR(50) NOT NULL,
+                location_id INTEGER NOT NULL,
+                source_location_id INTEGER,
+                reason VARCHAR(50),
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+                FOREIGN KEY (location_id) REFERENCES locations(id),
+                FOREIGN KEY (source_location_id) REFERENCES locations(id)
+                )
+                ''')
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS reorder_points (
+                variant_id INTEGER NOT NULL,
+                location_id INTEGER NOT NULL,
+                reorder_point INTEGER NOT NULL,
+                reorder_quantity INTEGER,
+
+                PRIMARY KEY (variant_id, location_id),
+                FOREIGN KEY (variant_id) REFERENCES variants(id),
+                FOREIGN KEY (location_id) REFERENCES locations(id)
+                )
+                ''')
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stock_alerts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                variant_id INTEGER NOT NULL,
+                location_id INTEGER NOT NULL,
+                type VARCHAR(50) NOT NULL,
+                available_amount INTEGER NOT NULL,
+                reorder_point INTEGER NOT NULL,
+                reorder_quantity INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                acknowledged_at TIMESTAMP,
+
+                FOREIGN KEY (variant_id) REFERENCES variants(id),
+                FOREIGN KEY (location_id) REFERENCES locations(id)
+                )
+                ''')
+    # Completed movements per day -> units moved and the net stock change, per (variant, location, type, reason)
+    rollups_exist = _tableExists(cursor, "movement_daily_rollups")
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS movement_daily_rollups (
+                day DATE NOT NULL,
+                variant_id INTEGER NOT NULL,
+                location_id INTEGER NOT NULL,
+                type VARCHAR(50) NOT NULL,
+                reason VARCHAR(50) NOT NULL,
+                movement_count INTEGER NOT NULL DEFAULT 0,
+                units INTEGER NOT NULL DEFAULT 0,
+                net_amount INTEGER NOT NULL DEFAULT 0,
+
+                PRIMARY KEY (day, variant_id, location_id, type, reason),
+                FOREIGN KEY (variant_id) REFERENCES variants(id),
+                FOREIGN KEY (location_id) REFERENCES locations(id)
+                ) WITHOUT ROWID
+                ''')
+    # A rebuilt ledger starts from the stock on hand, so recalculations keep the amounts recorded before it
+    if ledger_rebuilt:
+        cursor.execute("""INSERT INTO stock_baselines (variant_id, location_id, last_movement_id, amount)
+                       SELECT variant_id, location_id, 0, physical_amount FROM has_variants WHERE physical_amount != 0
+                       ON CONFLICT (variant_id, location_id) DO NOTHING""")
+    _addColumnIfMissing(cursor, "stock_movements", "order_id", "INTEGER REFERENCES movement_orders(id)")
+    # Databases created before reserved_amount existed get the column added and backfilled by reconcileReservedAmounts()
+    if _addColumnIfMissing(cursor, "has_variants", "reserved_amount", "INTEGER DEFAULT 0"):
+        _reconcileReservedAmountsLogic(conn)
+    # Databases created before the rollups existed get them built from the ledger once
+    if not rollups_exist:
+        _rebuildMovementRollupsLogic(conn)
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_has_products_logic ON has_variants(variant_id, location_id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_has_variants_location ON has_variants(location_id, variant_id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_movement_logic ON stock_movements(variant_id, location_id, type, status);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_movement_ledger ON stock_movements(variant_id, location_id, status, id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_movement_source_ledger ON stock_movements(variant_id, source_location_id, status, id) WHERE source_location_id IS NOT NULL;")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_movement_summary_logic ON stock_movement_summaries(variant_id, location_id, period);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_movement_order ON stock_movements(order_id) WHERE order_id IS NOT NULL;")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_movement_source ON stock_movements(source_location_id, variant_id) WHERE source_location_id IS NOT NULL;")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_alert_open ON stock_alerts(id) WHERE acknowledged_at IS NULL;")
+
+# temp -> creates a connection-local view, for connections where the catalog tables are in an attached database
+def _createSummaryViewLogic(conn, temp = False):
+    cursor = conn.cursor()
+    # The view is always recreated so existing databases pick up its latest definition
+    cursor.execute("DROP VIEW IF EXISTS {}v_inventory_summary;".format("temp." if temp else ""))
+    cursor.execute('''
+            CREATE {}VIEW v_inventory_summary AS
+            SELECT
+                h.variant_id AS variant_id,
+                p.name AS product_name,
+                v.description AS description,
+                v.current_price as current_price,
+                h.location_id AS location_id,
+                l.location_name AS location_name,
+                h.physical_amount AS physical_amount,
+                h.reserved_amount AS reserved_amount,
+                h.physical_amount - h.reserved_amount AS available_amount
+
+            FROM variants v
+            JOIN products p ON v.product_id = p.id
+            JOIN has_variants h ON v.id = h.variant_id
+            JOIN locations l ON h.location_id = l.id;
+
+                '''.format("TEMP " if temp else ""))
+
+# Applies the per-connection pragmas. WAL lets readers run concurrently with the single writer,
+# busy_timeout (ms) makes a blocked connection wait instead of failing with 'database is locked',
+# cache_size follows SQLite's convention (negative -> KiB, positive -> pages)
+def configureConnection(conn, wal = True, synchronous = 'NORMAL', busy_timeout = 5000, cache_size = -20000, read_only = False):
+    conn.execute("PRAGMA foreign_keys = ON;")
+    conn.execute("PRAGMA busy_timeout = {};".format(int(busy_timeout)))
+    conn.execute("PRAGMA cache_size = {};".format(int(cache_size)))
+    if wal:
+        conn.execute("PRAGMA journal_mode = WAL;")
+    if synchronous:
+        conn.execute("PRAGMA synchronous = {};".format(synchronous))
+    if read_only:
+        conn.execute("PRAGMA query_only = ON;")
+    return conn
+
+# Connection manager for multithreaded callers -> one shared writer connection guarded by a lock,
+# and one read-only connection per live thread (a thread's connection is closed once the thread has exited,
+# the next time a reader is opened). The wrapped functions are used unchanged on either:
+#
+#   manager = ConnectionManager('inventory.db')
+#   with manager.writer() as conn:
+#       addMovementOut(conn, variant, location, amount, reason, status)
+#   fetchReviews(manager.reader(), variant)
+class ConnectionManager:
+    def __init__(self, path = 'inventory.db', **pragmas):
+        self.path = path
+        self.pragmas = pragmas
+        self._writer = None
+        self._writer_lock = threading.RLock()
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+        self._closed = False
+
+    def _writerConnection(self):
+        if self._closed:
+            raise sqlite3.ProgrammingError("ConnectionManager is closed")
+        if self._writer is None:
+            self._writer = initDatabase(self.path, **self.pragmas)
+        return self._writer
+
+    # Yields the writer connection while holding the write lock, so writes from all threads are serialized
+    @contextmanager
+    def writer(self):
+        waited_from = perf_counter()
+        with self._writer_lock:
+            if _metrics is not None:
+                _metrics.observe("inventory_writer_lock_wait_seconds", perf_counter() - waited_from)
+            yield self._writerConnection()
+
+    # Returns this thread's read-only connection, opening it on first use
+    def reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            with self._writer_lock:
+                # Makes sure the schema exists before the first reader opens the file
+                self._writerConnection()
+            conn = sqlite3.connect(self.path, check_same_thread = False)
+            configureConnection(conn, read_only = True, **self.pragmas)
+            self._local.conn = conn
+            with self._readers_lock:
+                self._closeFinishedReaders()
+                self._readers.append((threading.current_thread(), conn))
+        return conn
+
+    # Worker pools replace their threads over time, so the connections of threads that are gone are closed
+    def _closeFinishedReaders(self):
+        alive = []
+        for thread, conn in self._readers:
+            if thread.is_alive():
+                alive.append((thread, conn))
+            else:
+                conn.close()
+        self._readers = alive
+
+    def readerCount(self):
+        with self._readers_lock:
+            return len(self._readers)
+
+    def close(self):
+        with self._writer_lock:
+            self._closed = True
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._readers_lock:
+            for thread, conn in self._readers:
+                conn.close()
+            self._readers = []
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Optional bounded LRU cache for catalog lookups (product name -> id, variant and location metadata).
+# It is process wide and assumes one database per process; the add paths invalidate what they change
+# and a rolled back transaction drops the keys it loaded or changed, so it never serves rows the database does not have.
+# Writes are invalidated again once they commit (another connection may have loaded the old row in between),
+# a key is not cached while the transaction that changed it is open, and a load that overlapped any invalidation
+# is returned but not cached.
+class LookupCache:
+    def __init__(self, maxsize = 4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            generation = self.generation
+        value = loader()
+        with self._lock:
+            if generation == self.generation:
+                self._entries[key] = value
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last = False)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits" : self.hits, "misses" : self.misses, "size" : len(self._entries), "maxsize" : self.maxsize}
+
+_lookup_cache = None
+# id(conn) -> (keys invalidated, keys loaded) by the transaction open on conn
+_transaction_keys = {}
+_transaction_keys_lock = threading.Lock()
+
+def enableLookupCache(maxsize = 4096):
+    global _lookup_cache
+    _lookup_cache = LookupCache(maxsize)
+    return _lookup_cache
+
+def disableLookupCache():
+    global _lookup_cache
+    _lookup_cache = None
+
+def clearLookupCache():
+    if _lookup_cache is not None:
+        _lookup_cache.clear()
+
+def lookupCacheStats():
+    return _lookup_cache.stats() if _lookup_cache is not None else None
+
+def _cachedLookup(conn, key, loader):
+    if _lookup_cache is None:
+        return loader()
+    if conn.in_transaction:
+        with _transaction_keys_lock:
+            invalidated, loaded = _transaction_keys.setdefault(id(conn), (set(), set()))
+            changed = key in invalidated
+            loaded.add(key)
+        if changed:
+            # Not committed yet -> other connections must not see it
+            return loader()
+    return _lookup_cache.get(key, loader)
+
+# Invalidates now and again when conn commits -> see _afterCommit()
+def _invalidateLookup(conn, key):
+    if _lookup_cache is None:
+        return
+    _lookup_cache.invalidate(key)
+    with _transaction_keys_lock:
+        _transaction_keys.setdefault(id(conn), (set(), set()))[0].add(key)
+
+# Runs once a transaction on conn has committed -> deferred cache invalidations, then stock alert callbacks
+def _afterCommit(conn):
+    with _transaction_keys_lock:
+        invalidated, loaded = _transaction_keys.pop(id(conn), ((), ()))
+    if _lookup_cache is not None:
+        for key in invalidated:
+            _lookup_cache.invalidate(key)
+    _fireStockAlerts(conn)
+
+# Only the keys the rolled back transaction loaded or changed can hold rows the database no longer has
+def _afterRollback(conn):
+    with _transaction_keys_lock:
+        invalidated, loaded = _transaction_keys.pop(id(conn), ((), ()))
+    if _lookup_cache is not None:
+        for key in set(invalidated) | set(loaded):
+            _lookup_cache.invalidate(key)
+    _discardStockAlerts(conn)
+
+# Timestamps are stored the way CURRENT_TIMESTAMP writes them so they compare correctly as text
+def _formatTimestamp(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+def _tableExists(cursor, table):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    return cursor.fetchone() is not None
+
+def _addColumnIfMissing(cursor, table, column, definition):
+    cursor.execute("PRAGMA table_info({})".format(table))
+    if column in [row[1] for row in cursor.fetchall()]:
+        return False
+    cursor.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, definition))
+    return True
+
+# Databases created by the first schema have a stock_movements table without id and change_amount (a missing comma
+# folded change_amount into source_location_id's type) and a non unique idx_has_products_logic, neither of which
+# CREATE ... IF NOT EXISTS replaces. Both are rebuilt when that is lossless, otherwise the error says what to fix.
+# Returns True when stock_movements was dropped
+def _migrateBaselineStockSchemaLogic(cursor):
+    ledger_rebuilt = False
+    if _tableExists(cursor, "stock_movements"):
+        cursor.execute("PRAGMA table_info(stock_movements)")
+        columns = [row[1] for row in cursor.fetchall()]
+        if "id" not in columns or "change_amount" not in columns:
+            cursor.execute("SELECT COUNT(*) FROM stock_movements")
+            if cursor.fetchone()[0]:
+                raise sqlite3.DatabaseError("stock_movements has the old schema without id/change_amount and still holds rows; "
+                                            "export and empty it before opening this database")
+            cursor.execute("DROP TABLE stock_movements")
+            ledger_rebuilt = True
+    cursor.execute("PRAGMA index_list(has_variants)")
+    if any(row[1] == "idx_has_products_logic" and not row[2] for row in cursor.fetchall()):
+        cursor.execute("SELECT variant_id, location_id FROM has_variants GROUP BY variant_id, location_id HAVING COUNT(*) > 1 LIMIT 1")
+        duplicate = cursor.fetchone()
+        if duplicate:
+            raise sqlite3.DatabaseError("has_variants has duplicate rows for variant {} at location {}; merge them so "
+                                        "idx_has_products_logic can be made unique".format(*duplicate))
+        cursor.execute("DROP INDEX idx_has_products_logic")
+        cursor.execute("CREATE UNIQUE INDEX idx_has_products_logic ON has_variants(variant_id, location_id);")
+    return ledger_rebuilt
+
 # Wrapper function for committing or rolling back transactions -> Ensures easy use of nested transactional functions without any data integrity problems
 
 def wrap_transaction(func):
     @wraps(func)
     def wrapper(conn,*args, **kwargs):
+        if _metrics is not None:
+            return _instrumentedTransaction(_metrics, func, conn, args, kwargs)
         try:
             result = func(conn, *args, **kwargs)
             conn.commit()
+            _afterCommit(conn)
             return result
         except Exception as e:
             conn.rollback()
+            _afterRollback(conn)
             raise e
+    # Marks the public API so facades (e.g. inventoryAsync) can discover it
+    wrapper.transactional = True
     return wrapper
 
+# Opt-in instrumentation of the wrapped functions -> wall time, commit latency, rows touched and rollbacks per function,
+# plus per-statement timings through sqlite3's trace callback, collected in an inventoryMetrics.MetricsRegistry
+_metrics = None
+_trace_statements = True
+_traced_connections = set()
+_traced_connections_lock = threading.Lock()
+
+def enableInstrumentation(registry = None, slow_query_threshold = 0.1, trace_statements = True):
+    global _metrics, _trace_statements
+    _metrics = registry or inventoryMetrics.MetricsRegistry(slow_query_threshold)
+    _trace_statements = trace_statements
+    return _metrics
+
+def disableInstrumentation():
+    global _metrics
+    _metrics = None
+
+def metricsSnapshot():
+    return _metrics.snapshot() if _metrics is not None else None
+
+def metricsPrometheus():
+    return _metrics.toPrometheus() if _metrics is not None else ""
+
+# sqlite3 keeps a single progress handler per connection, so the statement tracer and inventoryAsync's cancellation
+# check share it through these -> handler() is called about every `instructions` SQLite VM instructions (the finest
+# granularity any handler asked for), and the running statement is aborted as soon as one of them returns True
+_progress_handlers = {}
+_progress_handlers_lock = threading.Lock()
+
+def addProgressHandler(conn, handler, instructions = 10000):
+    with _progress_handlers_lock:
+        handlers = _progress_handlers.setdefault(id(conn), [])
+        handlers.append((handler, instructions))
+        current = tuple(handlers)
+    _installProgressHandlers(conn, current)
+
+def removeProgressHandler(conn, handler):
+    with _progress_handlers_lock:
+        handlers = _progress_handlers.get(id(conn), [])
+        handlers[:] = [entry for entry in handlers if entry[0] != handler]
+        current = tuple(handlers)
+        if not handlers:
+            _progress_handlers.pop(id(conn), None)
+    _installProgressHandlers(conn, current)
+
+def _installProgressHandlers(conn, handlers):
+    if not handlers:
+        conn.set_progress_handler(None, 0)
+        return
+    callables = [handler for handler, instructions in handlers]
+    # Every handler runs on every tick, the tracer relies on being called even when another one aborts
+    conn.set_progress_handler(lambda: any([handler() for handler in callables]), min(instructions for handler, instructions in handlers))
+
+def _instrumentedTransaction(metrics, func, conn, args, kwargs):
+    name = func.__name__
+    tracer = None
+    if _trace_statements:
+        with _traced_connections_lock:
+            # Nested wrapped calls are timed, but only the outermost one traces the connection's statements
+            if id(conn) not in _traced_connections:
+                _traced_connections.add(id(conn))
+                tracer = inventoryMetrics.StatementTracer(metrics, name)
+        if tracer is not None:
+            conn.set_trace_callback(tracer)
+            addProgressHandler(conn, tracer.progress, inventoryMetrics.TRACE_INSTRUCTIONS)
+    changes_before = conn.total_changes
+    started = perf_counter()
+    commit_seconds = 0.0
+    try:
+        result = func(conn, *args, **kwargs)
+        commit_started = perf_counter()
+        conn.commit()
+        commit_seconds = perf_counter() - commit_started
+        metrics.observe("inventory_commit_seconds", commit_seconds, function = name)
+        _afterCommit(conn)
+        return result
+    except Exception as e:
+        conn.rollback()
+        _afterRollback(conn)
+        metrics.increment("inventory_rollbacks_total", function = name)
+        raise e
+    finally:
+        seconds = perf_counter() - started
+        if tracer is not None:
+            conn.set_trace_callback(None)
+            removeProgressHandler(conn, tracer.progress)
+            tracer.close()
+            with _traced_connections_lock:
+                _traced_connections.discard(id(conn))
+            # Whatever the traced statements did not account for ran in Python (logic, parameter building, row handling)
+            metrics.observe("inventory_python_seconds", max(seconds - commit_seconds - tracer.sql_seconds, 0.0), function = name)
+        metrics.increment("inventory_calls_total", function = name)
+        metrics.increment("inventory_rows_touched_total", conn.total_changes - changes_before, function = name)
+        metrics.observe("inventory_transaction_seconds", seconds, function = name)
+        metrics.recordSlow("transaction", name, seconds, function = name)
+
 # _functionameLogic() are the wrapperless functions containing internal logic -> To be used when nesting functions
 # functionname() are the wrapped functions calling the logic functions -> To be used as public facing functions
 
 #-----------WRAPPED FUNCTIONS------------#
 @wrap_transaction
 def addLocation(conn, location_name, is_storage, address=''):
-    _addLocationLogic(conn, location_name, is_storage, address)
+    return _addLocationLogic(conn, location_name, is_storage, address)
+
+@wrap_transaction
+def getLocation(conn, location):
+    return _getLocationLogic(conn, location)
 
 @wrap_transaction
 def addProduct(conn, name, category):
@@ -174,14 +740,26 @@ def addProduct(conn, name, category):
 @wrap_transaction
 def findProductByName(conn, name):
     return _findProductByNameLogic(conn, name)
+
+@wrap_transaction
+def getVariant(conn, variant):
+    return _getVariantLogic(conn, variant)
     
 @wrap_transaction
 def addPrice(conn, variant, price, date_time = None):
-    _addPriceLogic(conn, variant, price, date_time = None)
+    _addPriceLogic(conn, variant, price, date_time)
+
+@wrap_transaction
+def getPriceAt(conn, variant, date_time):
+    return _getPriceAtLogic(conn, variant, date_time)
+
+@wrap_transaction
+def getPricesAt(conn, variant_ids, date_time):
+    return _getPricesAtLogic(conn, variant_ids, date_time)
 
 @wrap_transaction
 def addVariant(conn, product, description, current_price=None):
-    return _addVariantLogic(conn, product, description, current_price=None)
+    return _addVariantLogic(conn, product, description, current_price)
     
 @wrap_transaction    
 def addReview(conn, variant, text_body, user_name, rating):
@@ -195,6 +773,30 @@ def fetchReviews(conn, variant):
 def getVariantRating(conn, variant):
     return _getVariantRatingLogic(conn, variant)
 
+@wrap_transaction
+def getVariantRatings(conn, variant_ids):
+    return _getVariantRatingsLogic(conn, variant_ids)
+
+@wrap_transaction
+def getVariantRatingHistogram(conn, variant):
+    return _getVariantRatingHistogramLogic(conn, variant)
+
+@wrap_transaction
+def getProductRatings(conn, product_ids):
+    return _getProductRatingsLogic(conn, product_ids)
+
+@wrap_transaction
+def rebuildVariantRatings(conn):
+    return _rebuildVariantRatingsLogic(conn)
+
+@wrap_transaction
+def searchCatalog(conn, text, page = 0, page_size = 20, in_stock = False):
+    return _searchCatalogLogic(conn, text, page, page_size, in_stock)
+
+@wrap_transaction
+def rebuildSearchIndex(conn):
+    return _rebuildSearchIndexLogic(conn)
+
 @wrap_transaction
 def addMovementIn(conn, variant, location, amount, reason, status):
     return _addMovementInLogic(conn, variant, location, amount, reason, status)
@@ -231,23 +833,138 @@ def cancelMovementAdjust(conn, movement_id):
 def recalculatePhysicalAmount(conn, variant, location):
     return _recalculatePhysicalAmountLogic(conn, variant, location)
 
+@wrap_transaction
+def recalculateAllPhysicalAmounts(conn):
+    return _recalculateAllPhysicalAmountsLogic(conn)
+
+@wrap_transaction
+def takeStockSnapshots(conn, variant = None, location = None):
+    return _takeStockSnapshotsLogic(conn, variant, location)
+
+@wrap_transaction
+def addTransferOrder(conn, source_location, location, lines, reason = MovementTransferReason.INTERNAL, status = MovementStatus.IN_TRANSIT):
+    return _addTransferOrderLogic(conn, source_location, location, lines, reason, status)
+
+@wrap_transaction
+def updateTransferOrder(conn, order_id, status):
+    return _updateTransferOrderLogic(conn, order_id, status)
+
+# Checkout -> reserves every line (pending OUT movements) or none of them, raising InsufficientStockError with the short lines
+@wrap_transaction
+def reserveOrder(conn, location, lines, reason = MovementOutReason.SALE):
+    return _reserveOrderLogic(conn, location, lines, reason)
+
+@wrap_transaction
+def confirmOrder(conn, order_id):
+    return _settleReservationLogic(conn, order_id, MovementStatus.COMPLETED)
+
+@wrap_transaction
+def releaseOrder(conn, order_id):
+    return _settleReservationLogic(conn, order_id, MovementStatus.CANCELLED)
+
+@wrap_transaction
+def checkAvailability(conn, lines):
+    return _shortLinesLogic(conn, lines)
+
+# Aggregated completed movements between two days (inclusive) -> see _movementAnalyticsLogic
+@wrap_transaction
+def movementAnalytics(conn, start, end, by = 'category', period = None, type = None, reason = None, location = None):
+    return _movementAnalyticsLogic(conn, start, end, by, period, type, reason, location)
+
+@wrap_transaction
+def unitsSoldByCategory(conn, start, end, period = 'day'):
+    return _movementAnalyticsLogic(conn, start, end, 'category', period, MovementType.OUT, MovementOutReason.SALE)
+
+@wrap_transaction
+def netInflowByLocation(conn, start, end, period = 'week'):
+    return _movementAnalyticsLogic(conn, start, end, 'location', period)
+
+@wrap_transaction
+def rebuildMovementRollups(conn, since = None):
+    return _rebuildMovementRollupsLogic(conn, since)
+
+@wrap_transaction
+def fetchOrder(conn, order_id):
+    return _fetchOrderLogic(conn, order_id)
+
+@wrap_transaction
+def reconcileReservedAmounts(conn):
+    return _reconcileReservedAmountsLogic(conn)
+
+@wrap_transaction
+def setReorderPoint(conn, variant, location, reorder_point, reorder_quantity = None):
+    return _setReorderPointLogic(conn, variant, location, reorder_point, reorder_quantity)
+
+@wrap_transaction
+def removeReorderPoint(conn, variant, location):
+    return _removeReorderPointLogic(conn, variant, location)
+
+@wrap_transaction
+def fetchStockAlerts(conn, include_acknowledged = False, limit = 100):
+    return _fetchStockAlertsLogic(conn, include_acknowledged, limit)
+
+@wrap_transaction
+def acknowledgeStockAlerts(conn, alert_ids):
+    return _acknowledgeStockAlertsLogic(conn, alert_ids)
+
+# Not wrapped: commits once per chunk of chunk_size movements instead of once per call.
+# movements is an iterable of dicts with the keys variant, location, amount, type, reason and optionally status, source_location.
+# Returns {"inserted": n, "errors": [{"index", "movement", "error"}, ...]} -> failing rows are reported instead of aborting the batch
+def addMovements(conn, movements, chunk_size = 500):
+    return _addMovementsLogic(conn, movements, chunk_size)
+
+# Not wrapped: generators that page through large results with keyset pagination, holding at most page_size rows in memory
+def iterReviews(conn, variant, page_size = 500):
+    return _iterReviewsLogic(conn, variant, page_size)
+
+def iterMovements(conn, variant = None, location = None, status = None, since = None, page_size = 500):
+    return _iterMovementsLogic(conn, variant, location, status, since, page_size)
+
+def iterInventorySummary(conn, location = None, page_size = 500):
+    return _iterInventorySummaryLogic(conn, location, page_size)
+
+# Not wrapped: moves completed/cancelled movements created before cutoff into the archive database, chunk_size per commit,
+# leaving per-period summary rows behind. Returns {"archived": n, "summaries": n}
+def compactMovements(conn, cutoff, archive_path, period = 'month', chunk_size = 50000):
+    return _compactMovementsLogic(conn, cutoff, archive_path, period, chunk_size)
+
+# Attaches the archive and creates the temporary view v_stock_movements_all over hot and archived movements
+def attachArchive(conn, archive_path):
+    return _attachArchiveLogic(conn, archive_path)
+
 #-----------LOGIC FUNCTIONS------------#
 
 #### Location--------------------------------------------------------------------
 def _addLocationLogic(conn, location_name, is_storage, address=''):
     cursor = conn.cursor()
-    cursor.execute("INSERT INTO locations (location_name, is_storage, address) VALUES (?, ?, ?)", (location_name, is_storage, address))
+    cursor.execute("INSERT INTO locations (location_name, is_storage, address) VALUES (?, ?, ?) RETURNING id", (location_name, is_storage, address))
+    location_id = cursor.fetchone()[0]
+    _invalidateLookup(conn, ("location", location_id))
+    return location_id
+
+def _getLocationLogic(conn, location):
+    def load():
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, location_name, is_storage, address FROM locations WHERE id = ?", (location,))
+        row = cursor.fetchone()
+        if row is None:
+            raise ValueError("No location with id {}".format(location))
+        return {"id" : row[0], "location_name" : row[1], "is_storage" : bool(row[2]), "address" : row[3]}
+    return _cachedLookup(conn, ("location", location), load)
 
 #### Product---------------------------------------------------------------------
 def _addProductLogic(conn, name, category):
     cursor = conn.cursor()
     cursor.execute("INSERT INTO products (name, category) VALUES (?, ?) RETURNING id", (name, category))
     product_id = cursor.fetchone()[0]
+    _invalidateLookup(conn, ("product_name", name))
     return product_id
 def _findProductByNameLogic(conn, name):
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM products WHERE name = ?", (name,))
-    return cursor.fetchone()[0]
+    def load():
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM products WHERE name = ?", (name,))
+        return cursor.fetchone()[0]
+    return _cachedLookup(conn, ("product_name", name), load)
 
 #### Price history---------------------------------------------------------------
 def _addPriceLogic(conn, variant, price, date_time = None):
@@ -256,25 +973,58 @@ def _addPriceLogic(conn, variant, price, date_time = None):
         if isinstance(variant, str):
             #TODO Maybe make search by variant name (+ product name?)
             pass
-        if date_time and isinstance(date_time, datetime):
-            date_time_formatted = date_time.strftime('%Y-%m-%d %H:%M:%S')
-            cursor.execute("INSERT INTO price_history (variant_id, price, start_time) VALUES (?, ?, ?)", variant, price, date_time_formatted)
+        if date_time is not None:
+            # Normalized by SQLite so strings compare like CURRENT_TIMESTAMP; current_price is only refreshed on writes,
+            # so a future start_date would never take effect and is rejected
+            cursor.execute("SELECT datetime(?1), datetime(?1) > CURRENT_TIMESTAMP", (_formatTimestamp(date_time),))
+            start_date, future = cursor.fetchone()
+            if start_date is None:
+                raise ValueError("Invalid price start date: {}".format(date_time))
+            if future:
+                raise ValueError("Price start date {} is in the future".format(start_date))
+            cursor.execute("INSERT INTO price_history (variant_id, price, start_date) VALUES (?, ?, ?)", (variant, price, start_date))
         else:
             cursor.execute("INSERT INTO price_history (variant_id, price) VALUES (?, ?)", (variant, price))
         
-        cursor.execute("UPDATE variants SET current_price = ? WHERE id = ?", (price, variant))
+        # A back-dated entry must not replace a newer price
+        cursor.execute("""UPDATE variants SET current_price = IFNULL((
+                               SELECT price FROM price_history
+                               WHERE variant_id = ?1
+                               ORDER BY start_date DESC, id DESC LIMIT 1), current_price)
+                       WHERE id = ?1""", (variant,))
+        _invalidateLookup(conn, ("variant", variant))
     except sqlite3.Error as e:
         print("Error adding a price entry: ")
         raise e
 
+# Price in effect at date_time, served by idx_price_history_asof -> one index seek per variant.
+# date_time is normalized by datetime() like the start dates addPrice stores, so any ISO form compares correctly
+def _getPriceAtLogic(conn, variant, date_time):
+    cursor = conn.cursor()
+    cursor.execute("SELECT price FROM price_history WHERE variant_id = ? AND start_date <= datetime(?) ORDER BY start_date DESC, id DESC LIMIT 1", (variant, _formatTimestamp(date_time)))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+# Prices in effect at date_time for many variants in one query -> {variant_id: price or None}
+def _getPricesAtLogic(conn, variant_ids, date_time):
+    cursor = conn.cursor()
+    cursor.execute("""SELECT j.value, (
+                           SELECT p.price FROM price_history p
+                           WHERE p.variant_id = j.value AND p.start_date <= datetime(?)
+                           ORDER BY p.start_date DESC, p.id DESC LIMIT 1)
+                   FROM json_each(?) j""", (_formatTimestamp(date_time), json.dumps(list(variant_ids))))
+    return dict(cursor.fetchall())
+
 #### Variants--------------------------------------------------------------------
 def _addVariantLogic(conn, product, description, current_price=None):
     cursor = conn.cursor()
     try:
         if isinstance(product, str):
-            product = findProductByName(conn, product)
+            product = _findProductByNameLogic(conn, product)
         cursor.execute("INSERT INTO variants (product_id, description) VALUES (?, ?) RETURNING id", (product, description))
         variant_id = cursor.fetchone()[0]
+        _invalidateLookup(conn, ("variant", variant_id))
+        _indexVariantsLogic(conn, [variant_id])
         if current_price:
             _addPriceLogic(conn, variant_id, current_price)
         return variant_id
@@ -282,11 +1032,36 @@ def _addVariantLogic(conn, product, description, current_price=None):
         print("Error adding a product variant: ")
         raise e
 
+def _getVariantLogic(conn, variant):
+    def load():
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, product_id, description, current_price FROM variants WHERE id = ?", (variant,))
+        row = cursor.fetchone()
+        if row is None:
+            raise ValueError("No variant with id {}".format(variant))
+        return {"id" : row[0], "product_id" : row[1], "description" : row[2], "current_price" : row[3]}
+    return _cachedLookup(conn, ("variant", variant), load)
+
 #### Reviews---------------------------------------------------------------------
+# variant_ratings keeps review_count, rating_sum and a star histogram per variant, so ratings are read in O(1)
+# Reviews without a rating are not counted, matching AVG(rating)
 def _addReviewLogic(conn, variant, text_body, user_name, rating):
     cursor = conn.cursor()
     try:
-        cursor.execute("INSERT INTO reviews (variant_id, body, user_name, rating) VALUES (?, ?, ?, ?)", (variant, text_body, user_name, rating))
+        cursor.execute("INSERT INTO reviews (variant_id, body, user_name, rating) VALUES (?, ?, ?, ?) RETURNING id", (variant, text_body, user_name, rating))
+        review_id = cursor.fetchone()[0]
+        cursor.execute("INSERT INTO search_index (rowid, review, variant_id) VALUES (?, ?, ?)", (review_id, text_body, variant))
+        if rating is not None:
+            cursor.execute("""INSERT INTO variant_ratings (variant_id, review_count, rating_sum, stars_1, stars_2, stars_3, stars_4, stars_5)
+                           VALUES (?1, 1, ?2, ?2 = 1, ?2 = 2, ?2 = 3, ?2 = 4, ?2 = 5)
+                           ON CONFLICT (variant_id) DO UPDATE SET
+                               review_count = review_count + 1,
+                               rating_sum = rating_sum + excluded.rating_sum,
+                               stars_1 = stars_1 + excluded.stars_1,
+                               stars_2 = stars_2 + excluded.stars_2,
+                               stars_3 = stars_3 + excluded.stars_3,
+                               stars_4 = stars_4 + excluded.stars_4,
+                               stars_5 = stars_5 + excluded.stars_5""", (variant, rating))
     except sqlite3.Error as e:
         print("Error adding a review: ")
         raise e
@@ -298,119 +1073,994 @@ def _fetchReviewsLogic(conn, variant):
 
 def _getVariantRatingLogic(conn, variant):
     cursor = conn.cursor()
-    cursor.execute("SELECT AVG(rating) FROM reviews WHERE variant_id = ?", (variant,))
-    return cursor.fetchone()[0]
+    cursor.execute("SELECT CAST(rating_sum AS REAL) / review_count FROM variant_ratings WHERE variant_id = ? AND review_count > 0", (variant,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+# Average rating for a whole page of variants in one query -> {variant_id: average or None}
+def _getVariantRatingsLogic(conn, variant_ids):
+    variant_ids = list(variant_ids)
+    ratings = dict.fromkeys(variant_ids)
+    cursor = conn.cursor()
+    # The ids are passed as one JSON parameter so the query does not depend on SQLite's variable limit
+    cursor.execute("""SELECT variant_id, CAST(rating_sum AS REAL) / review_count FROM variant_ratings
+                   WHERE review_count > 0 AND variant_id IN (SELECT value FROM json_each(?))""", (json.dumps(variant_ids),))
+    ratings.update(cursor.fetchall())
+    return ratings
+
+def _ratingSummary(review_count, rating_sum, *stars):
+    return {"average" : rating_sum / review_count if review_count else None, "review_count" : review_count, "stars" : dict(zip(range(1, 6), stars))}
+
+def _getVariantRatingHistogramLogic(conn, variant):
+    cursor = conn.cursor()
+    cursor.execute("SELECT review_count, rating_sum, stars_1, stars_2, stars_3, stars_4, stars_5 FROM variant_ratings WHERE variant_id = ?", (variant,))
+    return _ratingSummary(*(cursor.fetchone() or (0, 0, 0, 0, 0, 0, 0)))
+
+# Rollup across all variants of each product -> {product_id: {"average", "review_count", "stars"}}
+def _getProductRatingsLogic(conn, product_ids):
+    product_ids = list(product_ids)
+    ratings = {product_id : _ratingSummary(0, 0, 0, 0, 0, 0, 0) for product_id in product_ids}
+    cursor = conn.cursor()
+    cursor.execute("""SELECT v.product_id, SUM(r.review_count), SUM(r.rating_sum), SUM(r.stars_1), SUM(r.stars_2), SUM(r.stars_3), SUM(r.stars_4), SUM(r.stars_5)
+                   FROM variants v JOIN variant_ratings r ON r.variant_id = v.id
+                   WHERE v.product_id IN (SELECT value FROM json_each(?))
+                   GROUP BY v.product_id""", (json.dumps(product_ids),))
+    for row in cursor.fetchall():
+        ratings[row[0]] = _ratingSummary(*row[1:])
+    return ratings
+
+def _rebuildVariantRatingsLogic(conn):
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM variant_ratings")
+    cursor.execute("""INSERT INTO variant_ratings (variant_id, review_count, rating_sum, stars_1, stars_2, stars_3, stars_4, stars_5)
+                   SELECT variant_id, COUNT(rating), SUM(rating), SUM(rating = 1), SUM(rating = 2), SUM(rating = 3), SUM(rating = 4), SUM(rating = 5)
+                   FROM reviews WHERE rating IS NOT NULL GROUP BY variant_id""")
+    return cursor.rowcount
+
+#### Full-text search---------------------------------------------------------------
+# Column weights for bm25() -> a hit in the product name counts the most, one in review text the least
+SEARCH_WEIGHTS = (10.0, 4.0, 6.0, 1.0)
+
+# (Re)indexes the name, category and description of the given variants, e.g. after their product changed
+def _indexVariantsLogic(conn, variant_ids):
+    variant_ids = json.dumps(list(variant_ids))
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM search_index WHERE rowid IN (SELECT - value FROM json_each(?))", (variant_ids,))
+    cursor.execute("""INSERT INTO search_index (rowid, name, category, description, variant_id)
+                   SELECT - v.id, p.name, p.category, v.description, v.id
+                   FROM variants v JOIN products p ON p.id = v.product_id
+                   WHERE v.id IN (SELECT value FROM json_each(?))""", (variant_ids,))
+
+def _rebuildSearchIndexLogic(conn):
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM search_index")
+    cursor.execute("""INSERT INTO search_index (rowid, name, category, description, variant_id)
+                   SELECT - v.id, p.name, p.category, v.description, v.id FROM variants v JOIN products p ON p.id = v.product_id""")
+    variants = cursor.rowcount
+    cursor.execute("INSERT INTO search_index (rowid, review, variant_id) SELECT id, body, variant_id FROM reviews WHERE body IS NOT NULL")
+    reviews = cursor.rowcount
+    cursor.execute("INSERT INTO search_index (search_index) VALUES ('optimize')")
+    return {"variants" : variants, "reviews" : reviews}
+
+# Every word of the text is a prefix term (e.g. "nike air" -> "nike"*, "air"*)
+def _searchTerms(text):
+    return ['"{}"*'.format(term) for term in re.findall(r"\w+", text or "")]
+
+# Ranked search over product names, categories, variant descriptions and reviews. Every term has to match one of the
+# variant's rows, not necessarily the same one (e.g. "nike colour" finds a Nike with "colour" in a review). A variant's
+# score is the sum of each term's best hit (lower is better). The page is cut before availability is summed over all
+# locations through v_inventory_summary, unless in_stock needs it to filter
+def _searchCatalogLogic(conn, text, page = 0, page_size = 20, in_stock = False):
+    terms = _searchTerms(text)
+    if not terms:
+        return []
+    hits = " UNION ALL ".join("SELECT variant_id, {} AS term, bm25(search_index, ?, ?, ?, ?) AS score FROM search_index WHERE search_index MATCH ?".format(index)
+                              for index in range(len(terms)))
+    available = "(SELECT IFNULL(SUM(s.available_amount), 0) FROM v_inventory_summary s WHERE s.variant_id = {}.variant_id)"
+    if in_stock:
+        page_query = """SELECT variant_id, score FROM ranked r WHERE {} > 0
+                        ORDER BY score, variant_id LIMIT ? OFFSET ?""".format(available.format("r"))
+    else:
+        page_query = "SELECT variant_id, score FROM ranked ORDER BY score, variant_id LIMIT ? OFFSET ?"
+    cursor = conn.cursor()
+    cursor.execute("""
+                   WITH hits AS MATERIALIZED ({hits}),
+                   term_hits AS (
+                       SELECT variant_id, term, MIN(score) AS score FROM hits GROUP BY variant_id, term),
+                   ranked AS (
+                       SELECT variant_id, SUM(score) AS score FROM term_hits GROUP BY variant_id HAVING COUNT(*) = ?),
+                   page AS ({page_query})
+                   SELECT pg.variant_id, p.name, p.category, v.description, v.current_price, {available}, pg.score
+                   FROM page pg JOIN variants v ON v.id = pg.variant_id JOIN products p ON p.id = v.product_id
+                   ORDER BY pg.score, pg.variant_id""".format(hits = hits, page_query = page_query, available = available.format("pg")),
+                   sum((SEARCH_WEIGHTS + (term,) for term in terms), ()) + (len(terms), page_size, page * page_size))
+    return [SearchResult(*row) for row in cursor.fetchall()]
 
 #### Functions for adding to and updating stock_movements table------------------
 def _addMovementLogic(conn, variant, location, source_location, amount, type, reason, status = MovementStatus.PENDING):
     cursor = conn.cursor()
 
-    cursor.execute("INSERT INTO stock_movements (variant_id, location_id, source_location_id, change_amount, type, reason, status) VALUES (?, ?, ?, ?, ?, ?) RETURNING id", (variant, location, source_location, amount, type, reason, status))
+    cursor.execute("INSERT INTO stock_movements (variant_id, location_id, source_location_id, change_amount, type, reason, status) VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id", (variant, location, source_location, amount, type, reason, status))
     return cursor.fetchone()[0]
 
 def _updateMovementLogic(conn, movement_id, status):
     cursor = conn.cursor()
     
-    cursor.execute("UPDATE stock_movement SET status = ? WHERE id = ?", (status, movement_id))
+    cursor.execute("UPDATE stock_movements SET status = ? WHERE id = ?", (status, movement_id))
 
 # Logic functions for IN type stock_movements------------------------------------
 def _addMovementInLogic(conn, variant, location, amount, reason, status = MovementStatus.PENDING):
-    _addMovementLogic(conn, variant, location, None, amount, MovementType.IN, reason, status)
+    movement_id = _addMovementLogic(conn, variant, location, None, amount, MovementType.IN, reason, status)
 
     if status == MovementStatus.COMPLETED:
         _completedMovementLogic(conn, variant, location, amount, False)
+        _rollupMovementsLogic(conn, [movement_id])
 
 def _updateMovementInLogic(conn, movement_id, status):
-    _updateMovementLogic(conn,movement_id, status)
     results = _fetchMovementInfo(conn, movement_id)
+    _updateMovementLogic(conn,movement_id, status)
 
     if results["status"] == MovementStatus.COMPLETED:
         if status != MovementStatus.COMPLETED:
-            _uncompletedMovementLogic(conn, results["variant"], results["location"], results["amount"], False)
+            _uncompletedMovementLogic(conn, results["variant"], results["location"], results["amount"], False, movement_id)
+            _rollupMovementsLogic(conn, [movement_id], -1)
     
     elif status == MovementStatus.COMPLETED:
-        _completedMovementLogic(conn, results["variant"], results["location"], results["amount"], False)
+        _completedMovementLogic(conn, results["variant"], results["location"], results["amount"], False, movement_id)
+        _rollupMovementsLogic(conn, [movement_id])
 
 # Logic functions for OUT type stock_movements-----------------------------------
 def _addMovementOutLogic(conn, variant, location, amount, reason, status = MovementStatus.COMPLETED):
-    _addMovementLogic(conn, variant, location, None, amount, MovementType.OUT, reason, status)
+    movement_id = _addMovementLogic(conn, variant, location, None, amount, MovementType.OUT, reason, status)
 
     if status == MovementStatus.COMPLETED:
         _completedMovementLogic(conn, variant, location, - amount, False)
+        _rollupMovementsLogic(conn, [movement_id])
+    elif status == MovementStatus.PENDING:
+        _applyReservedDeltasLogic(conn, {(variant, location) : amount})
 
 def _updateMovementOutLogic(conn, movement_id, status):
-    _updateMovementLogic(conn, movement_id, status)
     results = _fetchMovementInfo(conn, movement_id)
+    _updateMovementLogic(conn, movement_id, status)
 
     if results["status"] == MovementStatus.COMPLETED:
         if status != MovementStatus.COMPLETED:
-            _uncompletedMovementLogic(conn, results["variant"], results["location"], results["amount"], False)
+            _uncompletedMovementLogic(conn, results["variant"], results["location"], - results["amount"], False, movement_id)
+            _rollupMovementsLogic(conn, [movement_id], -1)
     
     elif status == MovementStatus.COMPLETED:
-        _completedMovementLogic(conn, results["variant"], results["location"], results["amount"], False)
+        _completedMovementLogic(conn, results["variant"], results["location"], - results["amount"], False, movement_id)
+        _rollupMovementsLogic(conn, [movement_id])
+
+    # Pending OUT movements hold a reservation on the stock
+    if results["status"] == MovementStatus.PENDING and status != MovementStatus.PENDING:
+        _applyReservedDeltasLogic(conn, {(results["variant"], results["location"]) : - results["amount"]})
+    elif results["status"] != MovementStatus.PENDING and status == MovementStatus.PENDING:
+        _applyReservedDeltasLogic(conn, {(results["variant"], results["location"]) : results["amount"]})
 
 # Logic functions for TRANSFER type stock_movements------------------------------
 def _addMovementTransferLogic(conn, variant, location, source_location, amount, reason, status = MovementStatus.IN_TRANSIT):
-    _addMovementLogic(conn, variant, location, source_location, amount, MovementType.TRANSFER, reason, status)
+    movement_id = _addMovementLogic(conn, variant, location, source_location, amount, MovementType.TRANSFER, reason, status)
 
     if status == MovementStatus.COMPLETED:
         _completedMovementLogic(conn, variant, location, amount, False)
         _completedMovementLogic(conn, variant, source_location, - amount, False)
+        _rollupMovementsLogic(conn, [movement_id])
 
 def _updateMovementTransferLogic(conn, movement_id, status):
-    _updateMovementLogic(conn, movement_id, status)
     results = _fetchMovementInfo(conn, movement_id)
+    _updateMovementLogic(conn, movement_id, status)
 
     if results["status"] == MovementStatus.COMPLETED:
         if status != MovementStatus.COMPLETED:
-            _uncompletedMovementLogic(conn, results["variant"], results["location"], results["amount"], False)
-            _uncompletedMovementLogic(conn, results["variant"], results["source_location"], results["amount"], False)
+            _uncompletedMovementLogic(conn, results["variant"], results["location"], results["amount"], False, movement_id)
+            _uncompletedMovementLogic(conn, results["variant"], results["source_location"], - results["amount"], False, movement_id)
+            _rollupMovementsLogic(conn, [movement_id], -1)
     
     elif status == MovementStatus.COMPLETED:
-        _completedMovementLogic(conn, results["variant"], results["location"], results["amount"], False)
-        _completedMovementLogic(conn, results["variant"], results["source_location"], - results["amount"], False)
+        _completedMovementLogic(conn, results["variant"], results["location"], results["amount"], False, movement_id)
+        _completedMovementLogic(conn, results["variant"], results["source_location"], - results["amount"], False, movement_id)
+        _rollupMovementsLogic(conn, [movement_id])
 
 # Logic functions for ADJUST type stock_movements--------------------------------
 def _addMovementAdjustLogic(conn, variant, location, amount, reason):
-    _addMovementLogic(conn, variant, location, None, amount, MovementType.ADJUST, reason, MovementStatus.COMPLETED)
+    movement_id = _addMovementLogic(conn, variant, location, None, amount, MovementType.ADJUST, reason, MovementStatus.COMPLETED)
 
     _completedMovementLogic(conn, variant, location, amount, True)
+    _rollupMovementsLogic(conn, [movement_id])
 
 def _cancelMovementAdjustLogic(conn, movement_id):
-    _updateMovementLogic(conn, movement_id, MovementStatus.CANCELLED)
     results = _fetchMovementInfo(conn, movement_id)
+    _updateMovementLogic(conn, movement_id, MovementStatus.CANCELLED)
 
     if results["status"] == MovementStatus.COMPLETED:
-        _recalculatePhysicalAmount(conn, results["variant"], results["source_location"])
+        # A snapshot taken after the adjustment has it baked in and can no longer be shifted, so it is dropped
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM stock_snapshots WHERE variant_id = ? AND location_id = ? AND last_movement_id >= ?", (results["variant"], results["location"], movement_id))
+        _recalculatePhysicalAmountLogic(conn, results["variant"], results["location"])
+        _rollupMovementsLogic(conn, [movement_id], -1)
 
-#### Function for updating the has_variants whenever a movement is marked as completed.
-def _completedMovementLogic(conn, variant, location, amount, replace = False):
+#### Bulk ingestion of stock_movements--------------------------------------------
+def _normaliseMovement(movement):
+    # Turns a movement mapping into an insertable row, filling in the per-type default status
+    type = movement["type"]
+    if not isinstance(type, MovementType):
+        raise ValueError("Unknown movement type: {}".format(type))
+    reason = movement["reason"]
+    if not isinstance(reason, MOVEMENT_REASONS[type]):
+        raise ValueError("Reason {} is not valid for {} movements".format(reason, type.name))
+    status = movement.get("status") or MOVEMENT_DEFAULT_STATUS[type]
+    if type == MovementType.ADJUST and status != MovementStatus.COMPLETED:
+        raise ValueError("Adjustments can only be recorded as completed")
+    source_location = movement.get("source_location")
+    if type == MovementType.TRANSFER and source_location is None:
+        raise ValueError("Transfers require a source_location")
+    return (movement["variant"], movement["location"], source_location, int(movement["amount"]), type, reason, status)
+
+def _movementStockEffects(variant, location, source_location, amount, type):
+    # physical_amount changes of a completed IN/OUT/TRANSFER movement -> [((variant, location), delta), ...]
+    if type == MovementType.OUT:
+        return [((variant, location), - amount)]
+    if type == MovementType.TRANSFER:
+        return [((variant, location), amount), ((variant, source_location), - amount)]
+    return [((variant, location), amount)]
+
+def _netStockChanges(rows):
+    # Folds completed rows, in order, into per (variant, location) deltas and adjustment overrides
+    deltas = {}
+    absolutes = {}
+    for variant, location, source_location, amount, type, reason, status in rows:
+        if status != MovementStatus.COMPLETED:
+            continue
+        key = (variant, location)
+        if type == MovementType.ADJUST:
+            absolutes[key] = amount
+            deltas.pop(key, None)
+            continue
+        for key, delta in _movementStockEffects(variant, location, source_location, amount, type):
+            deltas[key] = deltas.get(key, 0) + delta
+    return deltas, absolutes
+
+def _netReservedChanges(rows):
+    reserved = {}
+    for variant, location, source_location, amount, type, reason, status in rows:
+        if type == MovementType.OUT and status == MovementStatus.PENDING:
+            reserved[(variant, location)] = reserved.get((variant, location), 0) + amount
+    return reserved
+
+def _insertMovementsLogic(conn, rows, order_id = None):
     cursor = conn.cursor()
+    cursor.execute("SELECT IFNULL(MAX(id), 0) FROM stock_movements")
+    last_id = cursor.fetchone()[0]
+    cursor.executemany("INSERT INTO stock_movements (variant_id, location_id, source_location_id, change_amount, type, reason, status, order_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       [row + (order_id,) for row in rows])
+    _applyStockDeltasLogic(conn, *_netStockChanges(rows))
+    _applyReservedDeltasLogic(conn, _netReservedChanges(rows))
+    # The rows were inserted in this transaction, so they are exactly the ids after the previous maximum
+    if any(row[6] == MovementStatus.COMPLETED for row in rows):
+        cursor.execute("SELECT id FROM stock_movements WHERE id > ? AND status = 'COMPLETED'", (last_id,))
+        _rollupMovementsLogic(conn, [row[0] for row in cursor.fetchall()])
 
-    if not replace:
-        cursor.execute("SELECT h.physical_amount FROM has_products AS h WHERE variant_id = ? AND location_id = ?", (variant, location))
-        amount += int(cursor.fetchone()[0])
+def _addMovementsLogic(conn, movements, chunk_size = 500):
+    report = {"inserted" : 0, "errors" : []}
+    chunk = []
+    for index, movement in enumerate(movements):
+        try:
+            chunk.append((index, movement, _normaliseMovement(movement)))
+        except (KeyError, TypeError, ValueError) as e:
+            report["errors"].append({"index" : index, "movement" : movement, "error" : repr(e)})
+        if len(chunk) >= chunk_size:
+            _addMovementChunkLogic(conn, chunk, report)
+            chunk = []
+    if chunk:
+        _addMovementChunkLogic(conn, chunk, report)
+    return report
 
-    cursor.execute("UPDATE has_products SET physical_amount = ? WHERE variant_id = ? AND location_id = ?", (amount, variant, location))
+def _isInterrupt(error):
+    return isinstance(error, sqlite3.OperationalError) and str(error) == "interrupted"
 
-def _uncompletedMovementLogic(conn, variant, location, amount, replace = False):
+def _addMovementChunkLogic(conn, chunk, report):
+    # Fast path: the whole chunk in one executemany and one commit
+    try:
+        _insertMovementsLogic(conn, [row for index, movement, row in chunk])
+        conn.commit()
+        _afterCommit(conn)
+        report["inserted"] += len(chunk)
+        return
+    except sqlite3.Error as e:
+        conn.rollback()
+        _afterRollback(conn)
+        # An interrupted (cancelled) call stops here instead of replaying the chunk row by row
+        if _isInterrupt(e):
+            raise e
+
+    # Slow path: replay the chunk row by row under savepoints to find the offending rows, keep the rest. Outside a
+    # transaction every RELEASE would commit on its own, so the chunk is still committed once
+    cursor = conn.cursor()
+    cursor.execute("BEGIN")
+    for index, movement, row in chunk:
+        cursor.execute("SAVEPOINT movement_row")
+        pending = _pendingStockAlertCount(conn)
+        try:
+            _insertMovementsLogic(conn, [row])
+            cursor.execute("RELEASE movement_row")
+            report["inserted"] += 1
+        except sqlite3.Error as e:
+            if _isInterrupt(e):
+                conn.rollback()
+                _afterRollback(conn)
+                raise e
+            cursor.execute("ROLLBACK TO movement_row")
+            cursor.execute("RELEASE movement_row")
+            _discardStockAlerts(conn, pending)
+            report["errors"].append({"index" : index, "movement" : movement, "error" : repr(e)})
+    conn.commit()
+    _afterCommit(conn)
+
+#### Movement orders -> many movements created and settled together-------------
+# Moves the given movements to status in one pass: stock deltas, reservations and snapshots are applied as net
+# changes and the rows are updated with one statement. Adjustments are not supported. Returns the changed movement ids
+def _changeMovementsStatusLogic(conn, movement_ids, status):
     cursor = conn.cursor()
+    cursor.execute("""SELECT id, variant_id, location_id, source_location_id, change_amount, type, status
+                   FROM stock_movements WHERE id IN (SELECT value FROM json_each(?))""", (json.dumps(list(movement_ids)),))
+    deltas = {}
+    reserved = {}
+    shifts = []
+    changed = []
+    rollups = {1 : [], -1 : []}
+    for movement_id, variant, location, source_location, amount, type, previous in cursor.fetchall():
+        type = MovementType[type]
+        previous = MovementStatus[previous]
+        if type == MovementType.ADJUST:
+            raise ValueError("Adjustments can only be cancelled with cancelMovementAdjust")
+        if previous == status:
+            continue
+        changed.append(movement_id)
+        sign = 1 if status == MovementStatus.COMPLETED else -1 if previous == MovementStatus.COMPLETED else 0
+        if sign:
+            rollups[sign].append(movement_id)
+            for key, delta in _movementStockEffects(variant, location, source_location, amount, type):
+                shifts.append((movement_id, key[0], key[1], sign * delta))
+        if type == MovementType.OUT and MovementStatus.PENDING in (previous, status):
+            reserved[(variant, location)] = reserved.get((variant, location), 0) + (amount if status == MovementStatus.PENDING else - amount)
+    # Movements older than a completed adjustment at their (variant, location) are already counted by it
+    superseded = _supersededByAdjustLogic(conn, shifts)
+    shifts = [shift for shift in shifts if tuple(shift[:3]) not in superseded]
+    for movement_id, variant, location, delta in shifts:
+        deltas[(variant, location)] = deltas.get((variant, location), 0) + delta
+
+    cursor.execute("UPDATE stock_movements SET status = ? WHERE id IN (SELECT value FROM json_each(?))", (status, json.dumps(changed)))
+    _applyStockDeltasLogic(conn, deltas)
+    _applyReservedDeltasLogic(conn, reserved)
+    _shiftStockSnapshotsLogic(conn, shifts)
+    for sign, movement_ids in rollups.items():
+        _rollupMovementsLogic(conn, movement_ids, sign)
+    return changed
+
+def _fetchOrderLogic(conn, order_id):
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, type, status, location_id, source_location_id, reason, created_at FROM movement_orders WHERE id = ?", (order_id,))
+    row = cursor.fetchone()
+    if row is None:
+        raise ValueError("No movement order with id {}".format(order_id))
+    type = MovementType[row[1]]
+    cursor.execute("SELECT id, variant_id, location_id, change_amount, status FROM stock_movements WHERE order_id = ? ORDER BY id", (order_id,))
+    lines = [{"movement_id" : line[0], "variant" : line[1], "location" : line[2], "amount" : line[3], "status" : MovementStatus[line[4]]} for line in cursor.fetchall()]
+    return {"id" : row[0], "type" : type, "status" : MovementStatus[row[2]], "location" : row[3], "source_location" : row[4],
+            "reason" : MOVEMENT_REASONS[type][row[5]] if row[5] else None, "created_at" : row[6], "lines" : lines}
+
+# lines is [(variant, location, amount), ...] -> every line whose available stock is below the requested amount, in one query
+def _shortLinesLogic(conn, lines):
+    requested = {}
+    for variant, location, amount in lines:
+        requested[(variant, location)] = requested.get((variant, location), 0) + amount
+    cursor = conn.cursor()
+    cursor.execute("""SELECT json_extract(r.value, '$[0]'), json_extract(r.value, '$[1]'), json_extract(r.value, '$[2]'), IFNULL(h.physical_amount - h.reserved_amount, 0)
+                   FROM json_each(?) r
+                   LEFT JOIN has_variants h ON h.variant_id = json_extract(r.value, '$[0]') AND h.location_id = json_extract(r.value, '$[1]')
+                   WHERE IFNULL(h.physical_amount - h.reserved_amount, 0) < json_extract(r.value, '$[2]')""",
+                   (json.dumps([[variant, location, amount] for (variant, location), amount in requested.items()]),))
+    return [{"variant" : row[0], "location" : row[1], "requested" : row[2], "available" : row[3]} for row in cursor.fetchall()]
+
+# lines is [(variant, amount), ...] moved from source_location to location as one order, either IN_TRANSIT (settled
+# later with updateTransferOrder) or COMPLETED at once. The availability check runs under the write lock like _reserveOrderLogic
+def _addTransferOrderLogic(conn, source_location, location, lines, reason = MovementTransferReason.INTERNAL, status = MovementStatus.IN_TRANSIT):
+    lines = [(variant, int(amount)) for variant, amount in lines]
+    if not lines or any(amount <= 0 for variant, amount in lines):
+        raise ValueError("A transfer order needs at least one line and every amount must be positive")
+    if status not in (MovementStatus.IN_TRANSIT, MovementStatus.COMPLETED):
+        raise ValueError("Transfer orders can only be created in transit or completed")
+    if source_location == location:
+        raise ValueError("A transfer order needs two different locations")
+    cursor = conn.cursor()
+    if not conn.in_transaction:
+        cursor.execute("BEGIN IMMEDIATE")
+    short = _shortLinesLogic(conn, [(variant, source_location, amount) for variant, amount in lines])
+    if short:
+        raise InsufficientStockError(short)
+
+    cursor.execute("INSERT INTO movement_orders (type, status, location_id, source_location_id, reason) VALUES (?, ?, ?, ?, ?) RETURNING id",
+                   (MovementType.TRANSFER, status, location, source_location, reason))
+    order_id = cursor.fetchone()[0]
+    _insertMovementsLogic(conn, [(variant, location, source_location, amount, MovementType.TRANSFER, reason, status) for variant, amount in lines], order_id)
+    return order_id
+
+# Completes or cancels every line of an IN_TRANSIT order that is still in transit at once. Stock in transit is not held
+# at the source, so completing checks the source again, under the write lock like _reserveOrderLogic
+def _updateTransferOrderLogic(conn, order_id, status):
+    if status not in (MovementStatus.COMPLETED, MovementStatus.CANCELLED):
+        raise ValueError("Transfer orders can only be completed or cancelled")
+    cursor = conn.cursor()
+    if not conn.in_transaction:
+        cursor.execute("BEGIN IMMEDIATE")
+    order = _fetchOrderLogic(conn, order_id)
+    if order["type"] != MovementType.TRANSFER:
+        raise ValueError("Movement order {} is not a transfer order".format(order_id))
+    if order["status"] != MovementStatus.IN_TRANSIT:
+        raise ValueError("Transfer order {} is already {}".format(order_id, order["status"].name))
+    lines = [line for line in order["lines"] if line["status"] == MovementStatus.IN_TRANSIT]
+    if status == MovementStatus.COMPLETED:
+        short = _shortLinesLogic(conn, [(line["variant"], order["source_location"], line["amount"]) for line in lines])
+        if short:
+            raise InsufficientStockError(short)
+    cursor.execute("UPDATE movement_orders SET status = ? WHERE id = ?", (status, order_id))
+    return _changeMovementsStatusLogic(conn, [line["movement_id"] for line in lines], status)
+
+# lines is [(variant, amount), ...] reserved at location as one order. The write lock is taken before the availability
+# check (BEGIN IMMEDIATE), so no other connection can reserve the same stock between the check and the insert
+def _reserveOrderLogic(conn, location, lines, reason = MovementOutReason.SALE):
+    lines = [(variant, int(amount)) for variant, amount in lines]
+    if not lines or any(amount <= 0 for variant, amount in lines):
+        raise ValueError("An order needs at least one line and every amount must be positive")
+    cursor = conn.cursor()
+    if not conn.in_transaction:
+        cursor.execute("BEGIN IMMEDIATE")
+    short = _shortLinesLogic(conn, [(variant, location, amount) for variant, amount in lines])
+    if short:
+        raise InsufficientStockError(short)
+
+    cursor.execute("INSERT INTO movement_orders (type, status, location_id, reason) VALUES (?, ?, ?, ?) RETURNING id",
+                   (MovementType.OUT, MovementStatus.PENDING, location, reason))
+    order_id = cursor.fetchone()[0]
+    _insertMovementsLogic(conn, [(variant, location, None, amount, MovementType.OUT, reason, MovementStatus.PENDING) for variant, amount in lines], order_id)
+    return order_id
+
+# Confirms (COMPLETED) or releases (CANCELLED) every still pending line of a reservation at once
+def _settleReservationLogic(conn, order_id, status):
+    order = _fetchOrderLogic(conn, order_id)
+    if order["type"] != MovementType.OUT:
+        raise ValueError("Movement order {} is not a reservation".format(order_id))
+    if order["status"] != MovementStatus.PENDING:
+        raise ValueError("Reservation {} is already {}".format(order_id, order["status"].name))
+    cursor = conn.cursor()
+    cursor.execute("UPDATE movement_orders SET status = ? WHERE id = ?", (status, order_id))
+    return _changeMovementsStatusLogic(conn, [line["movement_id"] for line in order["lines"] if line["status"] == MovementStatus.PENDING], status)
+
+#### Function for updating the has_variants whenever a movement is marked as completed.
+# movement_id is passed when an existing movement changes status, so snapshots that already cover it are shifted too.
+# An adjustment counts everything recorded before it, so a movement older than a completed ADJUST changes nothing
+def _completedMovementLogic(conn, variant, location, amount, replace = False, movement_id = None):
+    if replace:
+        _applyStockDeltasLogic(conn, {}, {(variant, location) : amount})
+    elif movement_id is None:
+        _applyStockDeltasLogic(conn, {(variant, location) : amount})
+    elif not _supersededByAdjustLogic(conn, [(movement_id, variant, location, amount)]):
+        _applyStockDeltasLogic(conn, {(variant, location) : amount})
+        _shiftStockSnapshotsLogic(conn, [(movement_id, variant, location, amount)])
+
+def _uncompletedMovementLogic(conn, variant, location, amount, replace = False, movement_id = None):
     # Cancelling adjustments is not supported by this function-------------------
     if not replace:
-        cursor.execute("SELECT h.physical_amount FROM has_products AS h WHERE variant_id = ? AND location_id = ?", (variant, location))
-        amount = int(cursor.fetchone()[0]) - amount
-        cursor.execute("UPDATE has_products SET physical_amount = ? WHERE variant_id = ? AND location_id = ?", (amount, variant, location))
+        _completedMovementLogic(conn, variant, location, - amount, False, movement_id)
+
+# shifts is a list of (movement_id, variant, location, delta) -> the set of (movement_id, variant, location) that a completed
+# ADJUST with a higher id (hot, or compacted into stock_movement_summaries) has already overridden
+def _supersededByAdjustLogic(conn, shifts):
+    if not shifts:
+        return set()
+    cursor = conn.cursor()
+    cursor.execute("""SELECT s.movement_id, s.variant_id, s.location_id
+                   FROM (SELECT json_extract(value, '$[0]') AS movement_id, json_extract(value, '$[1]') AS variant_id,
+                                json_extract(value, '$[2]') AS location_id FROM json_each(?)) s
+                   WHERE EXISTS (SELECT 1 FROM stock_movements m
+                                 WHERE m.variant_id = s.variant_id AND m.location_id = s.location_id
+                                 AND m.type = 'ADJUST' AND m.status = 'COMPLETED' AND m.id > s.movement_id)
+                   OR EXISTS (SELECT 1 FROM stock_movement_summaries c
+                              WHERE c.variant_id = s.variant_id AND c.location_id = s.location_id
+                              AND c.type = 'ADJUST' AND c.status = 'COMPLETED' AND c.last_movement_id > s.movement_id)""",
+                   (json.dumps([[movement_id, variant, location] for movement_id, variant, location, delta in shifts]),))
+    return set(cursor.fetchall())
+
+#### Function for writing net physical_amount changes to has_variants in one pass
+# deltas maps (variant, location) -> amount added to physical_amount
+# absolutes maps (variant, location) -> amount physical_amount is set to (adjustments), applied before the deltas
+def _applyStockDeltasLogic(conn, deltas, absolutes = None):
+    keys = set(deltas) | set(absolutes or ())
+    before = _reorderStateLogic(conn, keys)
+    cursor = conn.cursor()
+    if absolutes:
+        cursor.executemany("""INSERT INTO has_variants (variant_id, location_id, physical_amount) VALUES (?, ?, ?)
+                           ON CONFLICT (variant_id, location_id) DO UPDATE SET physical_amount = excluded.physical_amount""",
+                           [(variant, location, amount) for (variant, location), amount in absolutes.items()])
+    cursor.executemany("""INSERT INTO has_variants (variant_id, location_id, physical_amount) VALUES (?, ?, ?)
+                       ON CONFLICT (variant_id, location_id) DO UPDATE SET physical_amount = physical_amount + excluded.physical_amount""",
+                       [(variant, location, amount) for (variant, location), amount in deltas.items() if amount])
+    _emitStockAlertsLogic(conn, before)
+
+#### Function for writing net reserved_amount changes to has_variants in one pass
+# reserved maps (variant, location) -> amount added to reserved_amount (pending OUT movements)
+def _applyReservedDeltasLogic(conn, reserved):
+    before = _reorderStateLogic(conn, [key for key, amount in reserved.items() if amount])
+    cursor = conn.cursor()
+    cursor.executemany("""INSERT INTO has_variants (variant_id, location_id, reserved_amount) VALUES (?, ?, ?)
+                       ON CONFLICT (variant_id, location_id) DO UPDATE SET reserved_amount = reserved_amount + excluded.reserved_amount""",
+                       [(variant, location, amount) for (variant, location), amount in reserved.items() if amount])
+    _emitStockAlertsLogic(conn, before)
+
+#### Function for rebuilding reserved_amount from the ledger, returns the rows that had drifted
+def _reconcileReservedAmountsLogic(conn):
+    cursor = conn.cursor()
+    cursor.execute("""
+                   WITH ledger AS (
+                       SELECT variant_id, location_id, SUM(change_amount) AS amount
+                       FROM stock_movements
+                       WHERE type = 'OUT' AND status = 'PENDING'
+                       GROUP BY variant_id, location_id)
+                   SELECT h.variant_id, h.location_id, h.reserved_amount, IFNULL(l.amount, 0)
+                   FROM has_variants h LEFT JOIN ledger l ON l.variant_id = h.variant_id AND l.location_id = h.location_id
+                   WHERE IFNULL(h.reserved_amount, 0) != IFNULL(l.amount, 0)
+                   UNION ALL
+                   SELECT l.variant_id, l.location_id, NULL, l.amount
+                   FROM ledger l LEFT JOIN has_variants h ON l.variant_id = h.variant_id AND l.location_id = h.location_id
+                   WHERE h.variant_id IS NULL
+                   """)
+    drift = [{"variant" : row[0], "location" : row[1], "reserved_amount" : row[2], "ledger_amount" : row[3]} for row in cursor.fetchall()]
+    before = _reorderStateLogic(conn, [(row["variant"], row["location"]) for row in drift])
+    cursor.executemany("""INSERT INTO has_variants (variant_id, location_id, reserved_amount) VALUES (?, ?, ?)
+                       ON CONFLICT (variant_id, location_id) DO UPDATE SET reserved_amount = excluded.reserved_amount""",
+                       [(row["variant"], row["location"], row["ledger_amount"]) for row in drift])
+    _emitStockAlertsLogic(conn, before)
+    return drift
 
 #### Function for fetching the data from stock_movements for a given id----------
 def _fetchMovementInfo(conn, movement_id):
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM stock_movements WHERE id = ?", (movement_id,))
-    return {"id" : cursor.fetchone()[0], "variant" : cursor.fetchone()[1], "location" : cursor.fetchone()[2], "source_location" : cursor.fetchone()[3], "amount" : cursor.fetchone()[4], "type" : cursor.fetchone()[5], "reason" : cursor.fetchone()[6], "status" : cursor.fetchone()[7], "created_at" : cursor.fetchone()[8]}
+    cursor.execute("SELECT id, variant_id, location_id, source_location_id, change_amount, type, reason, status, created_at FROM stock_movements WHERE id = ?", (movement_id,))
+    row = cursor.fetchone()
+    if row is None:
+        raise ValueError("No stock movement with id {}".format(movement_id))
+    type = MovementType[row[5]]
+    return {"id" : row[0], "variant" : row[1], "location" : row[2], "source_location" : row[3], "amount" : row[4], "type" : type, "reason" : MOVEMENT_REASONS[type][row[6]], "status" : MovementStatus[row[7]], "created_at" : row[8]}
+
+#### Stock snapshots and recalculation from the ledger----------------------------
+# A snapshot stores the ledger amount of a (variant, location) up to last_movement_id, so recalculating only replays
+# the movements after it. When an older movement changes status later the snapshot is shifted by the same delta.
+SNAPSHOT_INTERVAL = 1000
+
+# Ledger amount per (variant, location) -> completed IN/OUT/TRANSFER movements are summed on top of the snapshot
+# (or else the baseline left by compacted movements, or 0), and the latest completed ADJUST replaces every movement with
+# a lower id, whenever that movement completed. Adjustments already compacted are found through their summary rows.
+# Returns rows of (variant_id, location_id, amount, replayed, last_id)
+_LEDGER_QUERY = """
+    WITH compacted_adjust AS (
+        SELECT variant_id, location_id, MAX(last_movement_id) AS adjust_id FROM stock_movement_summaries
+        WHERE type = 'ADJUST' AND status = 'COMPLETED' {summary_filter} GROUP BY variant_id, location_id),
+    ledger AS (
+        SELECT variant_id, location_id, id, type, CASE WHEN type = 'OUT' THEN - change_amount ELSE change_amount END AS amount
+        FROM {movements} WHERE status = 'COMPLETED' {location_filter}
+        UNION ALL
+        SELECT variant_id, source_location_id, id, type, - change_amount
+        FROM {movements} WHERE status = 'COMPLETED' AND type = 'TRANSFER' {source_filter}),
+    replay AS (
+        SELECT l.* FROM ledger l
+        LEFT JOIN {snapshots} s ON s.variant_id = l.variant_id AND s.location_id = l.location_id
+        LEFT JOIN compacted_adjust c ON c.variant_id = l.variant_id AND c.location_id = l.location_id
+        WHERE l.id > MAX(IFNULL(s.last_movement_id, 0), IFNULL(c.adjust_id, 0))),
+    last_adjust AS (
+        SELECT variant_id, location_id, MAX(id) AS adjust_id FROM replay WHERE type = 'ADJUST' GROUP BY variant_id, location_id),
+    totals AS (
+        SELECT r.variant_id, r.location_id, a.adjust_id, COUNT(*) AS replayed, MAX(r.id) AS last_id,
+               SUM(CASE WHEN a.adjust_id IS NULL OR r.id > a.adjust_id OR (r.id = a.adjust_id AND r.type = 'ADJUST') THEN r.amount ELSE 0 END) AS amount
+        FROM replay r LEFT JOIN last_adjust a ON a.variant_id = r.variant_id AND a.location_id = r.location_id
+        GROUP BY r.variant_id, r.location_id),
+    pairs AS (
+        SELECT variant_id, location_id FROM {pairs_source}
+        UNION SELECT variant_id, location_id FROM totals)
+    SELECT p.variant_id AS variant_id, p.location_id AS location_id,
+           CASE WHEN t.adjust_id IS NOT NULL THEN t.amount ELSE COALESCE(s.amount, b.amount, 0) + IFNULL(t.amount, 0) END AS amount,
+           IFNULL(t.replayed, 0) AS replayed, MAX(IFNULL(t.last_id, 0), IFNULL(s.last_movement_id, 0)) AS last_id
+    FROM pairs p
+    LEFT JOIN totals t ON t.variant_id = p.variant_id AND t.location_id = p.location_id
+    LEFT JOIN {snapshots} s ON s.variant_id = p.variant_id AND s.location_id = p.location_id
+    LEFT JOIN stock_baselines b ON b.variant_id = p.variant_id AND b.location_id = p.location_id
+    """
+_NO_SNAPSHOTS = "(SELECT NULL AS variant_id, NULL AS location_id, NULL AS last_movement_id, NULL AS amount WHERE 0)"
+_ALL_LEDGER_QUERY = _LEDGER_QUERY.format(movements = "stock_movements", snapshots = "stock_snapshots", summary_filter = "",
+                                         location_filter = "", source_filter = "", pairs_source = "has_variants")
+
+def _ledgerAmountsLogic(conn, variant = None, location = None):
+    cursor = conn.cursor()
+    if variant is None:
+        cursor.execute(_ALL_LEDGER_QUERY)
+    else:
+        # Nothing at or below the checkpoint is replayed, so both ledger branches range-seek past it on
+        # idx_movement_ledger / idx_movement_source_ledger instead of reading the pair's whole history
+        cursor.execute("""SELECT MAX(IFNULL((SELECT last_movement_id FROM stock_snapshots WHERE variant_id = :variant AND location_id = :location), 0),
+                                     IFNULL((SELECT MAX(last_movement_id) FROM stock_movement_summaries
+                                             WHERE variant_id = :variant AND location_id = :location AND type = 'ADJUST' AND status = 'COMPLETED'), 0))""",
+                       {"variant" : variant, "location" : location})
+        checkpoint = cursor.fetchone()[0]
+        cursor.execute(_LEDGER_QUERY.format(movements = "stock_movements", snapshots = "stock_snapshots",
+                                            summary_filter = "AND variant_id = :variant AND location_id = :location",
+                                            location_filter = "AND variant_id = :variant AND location_id = :location AND id > :checkpoint",
+                                            source_filter = "AND variant_id = :variant AND source_location_id = :location AND id > :checkpoint",
+                                            pairs_source = "(SELECT :variant AS variant_id, :location AS location_id)"),
+                       {"variant" : variant, "location" : location, "checkpoint" : checkpoint})
+    return cursor.fetchall()
 
-#### Function for summing up all transactions and updating the physical_amount---
 def _recalculatePhysicalAmountLogic(conn, variant, location):
+    variant_id, location_id, amount, replayed, last_id = _ledgerAmountsLogic(conn, variant, location)[0]
+    _applyStockDeltasLogic(conn, {}, {(variant, location) : amount})
+    # Periodically move the checkpoint forward so the next recalculation replays less
+    if replayed >= SNAPSHOT_INTERVAL:
+        _writeStockSnapshotsLogic(conn, [(variant, location, amount)])
+    return amount
+
+# Recalculates every (variant, location) in one grouped query and fixes physical_amount where it drifted from the ledger.
+# The comparison runs in SQL, so only the drifted rows reach Python
+def _recalculateAllPhysicalAmountsLogic(conn):
+    cursor = conn.cursor()
+    cursor.execute("""SELECT h.variant_id, h.location_id, h.physical_amount, l.amount
+                   FROM has_variants h JOIN ({}) l ON l.variant_id = h.variant_id AND l.location_id = h.location_id
+                   WHERE h.physical_amount IS NOT l.amount""".format(_ALL_LEDGER_QUERY))
+    drift = [{"variant" : variant, "location" : location, "physical_amount" : physical_amount, "ledger_amount" : ledger_amount}
+             for variant, location, physical_amount, ledger_amount in cursor.fetchall()]
+    _applyStockDeltasLogic(conn, {}, {(row["variant"], row["location"]) : row["ledger_amount"] for row in drift})
+    return drift
+
+def _takeStockSnapshotsLogic(conn, variant = None, location = None):
+    rows = _ledgerAmountsLogic(conn, variant, location)
+    _writeStockSnapshotsLogic(conn, [(row[0], row[1], row[2]) for row in rows])
+    return len(rows)
+
+def _writeStockSnapshotsLogic(conn, snapshots):
+    # Snapshots cover every movement recorded so far -> any of them changing status later shifts the snapshot
+    cursor = conn.cursor()
+    cursor.execute("SELECT IFNULL(MAX(id), 0) FROM stock_movements")
+    last_movement_id = cursor.fetchone()[0]
+    cursor.executemany("""INSERT INTO stock_snapshots (variant_id, location_id, last_movement_id, amount) VALUES (?, ?, ?, ?)
+                       ON CONFLICT (variant_id, location_id) DO UPDATE SET
+                           last_movement_id = excluded.last_movement_id, amount = excluded.amount, created_at = CURRENT_TIMESTAMP""",
+                       [(variant, location, last_movement_id, amount) for variant, location, amount in snapshots])
+
+# shifts is a list of (movement_id, variant, location, delta) for movements whose completion changed after they were recorded
+def _shiftStockSnapshotsLogic(conn, shifts):
+    cursor = conn.cursor()
+    cursor.executemany("UPDATE stock_snapshots SET amount = amount + ? WHERE variant_id = ? AND location_id = ? AND last_movement_id >= ?",
+                       [(delta, variant, location, movement_id) for movement_id, variant, location, delta in shifts if delta])
+
+#### Streaming readers------------------------------------------------------------
+# Every page is a fresh query continuing after the last key seen, so no cursor or read transaction is held between pages
+def _iterPagesLogic(conn, page_query, first_key, page_size):
+    # page_query(key) -> (sql, params) selecting the rows after key, ordered by key, the key being the leading column(s)
+    cursor = conn.cursor()
+    key = first_key
+    while True:
+        sql, params = page_query(key)
+        cursor.execute(sql + " LIMIT ?", params + (page_size,))
+        rows = cursor.fetchmany(page_size)
+        for row in rows:
+            yield row
+        if len(rows) < page_size:
+            return
+        key = rows[-1]
+
+def _iterReviewsLogic(conn, variant, page_size = 500):
+    def page_query(last):
+        return ("SELECT id, variant_id, body, user_name, rating, created_at FROM reviews WHERE variant_id = ? AND id > ? ORDER BY id",
+                (variant, last[0]))
+    for row in _iterPagesLogic(conn, page_query, (0,), page_size):
+        yield Review._make(row)
+
+def _iterMovementsLogic(conn, variant = None, location = None, status = None, since = None, page_size = 500):
+    filters = []
+    params = []
+    if variant is not None:
+        filters.append("variant_id = ?")
+        params.append(variant)
+    if location is not None:
+        filters.append("location_id = ?")
+        params.append(location)
+    if status is not None:
+        filters.append("status = ?")
+        params.append(status)
+    if since is not None:
+        filters.append("created_at >= ?")
+        params.append(_formatTimestamp(since))
+
+    def page_query(last):
+        where = " AND ".join(["id > ?"] + filters)
+        return ("SELECT id, variant_id, location_id, source_location_id, change_amount, type, reason, status, created_at FROM stock_movements WHERE " + where + " ORDER BY id",
+                (last[0],) + tuple(params))
+    for row in _iterPagesLogic(conn, page_query, (0,), page_size):
+        type = MovementType[row[5]]
+        yield Movement(row[0], row[1], row[2], row[3], row[4], type, MOVEMENT_REASONS[type][row[6]], MovementStatus[row[7]], row[8])
+
+def _iterInventorySummaryLogic(conn, location = None, page_size = 500):
+    columns = ", ".join(InventoryRow._fields)
+    def page_query(last):
+        if location is None:
+            return ("SELECT " + columns + " FROM v_inventory_summary WHERE (variant_id, location_id) > (?, ?) ORDER BY variant_id, location_id",
+                    (last[0], last[4]))
+        return ("SELECT " + columns + " FROM v_inventory_summary WHERE location_id = ? AND variant_id > ? ORDER BY variant_id",
+                (location, last[0]))
+    for row in _iterPagesLogic(conn, page_query, (0, None, None, None, 0), page_size):
+        yield InventoryRow._make(row)
+
+#### Ledger compaction and archival-----------------------------------------------
+# Old completed/cancelled movements are moved to a separate archive database and rolled up into stock_movement_summaries.
+# What they contributed to each (variant, location) is folded into stock_baselines, so recalculation never needs them again.
+# Archived movements are final -> they can no longer change status.
+COMPACTION_PERIODS = {'day' : '%Y-%m-%d', 'week' : '%Y-W%W', 'month' : '%Y-%m', 'year' : '%Y'}
+_MOVEMENT_COLUMNS = "id, variant_id, location_id, source_location_id, change_amount, type, status, reason, created_at, order_id"
+
+def _attachArchiveLogic(conn, archive_path):
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA database_list")
+    if "archive" not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archive.stock_movements (
+                id INTEGER PRIMARY KEY,
+                variant_id INTEGER NOT NULL,
+                location_id INTEGER NOT NULL,
+                source_location_id INTEGER,
+                change_amount INTEGER DEFAULT 0,
+                type VARCHAR(50),
+                status VARCHAR(50),
+                reason VARCHAR(50),
+                created_at TIMESTAMP,
+                order_id INTEGER,
+                archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
+                ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_movement_logic ON stock_movements(variant_id, location_id, created_at)")
+    # Views in main cannot reference an attached database, so the union view is a temporary one
+    cursor.execute("DROP VIEW IF EXISTS temp.v_stock_movements_all")
+    cursor.execute("""CREATE TEMP VIEW v_stock_movements_all AS
+                   SELECT {columns}, 0 AS archived FROM main.stock_movements
+                   UNION ALL
+                   SELECT {columns}, 1 AS archived FROM archive.stock_movements""".format(columns = _MOVEMENT_COLUMNS))
+    conn.commit()
+
+def _compactMovementsLogic(conn, cutoff, archive_path, period = 'month', chunk_size = 50000):
+    period_format = COMPACTION_PERIODS[period]
+    _attachArchiveLogic(conn, archive_path)
+    cursor = conn.cursor()
+    cursor.execute("DROP TABLE IF EXISTS temp.compaction_movements")
+    cursor.execute("CREATE TEMP TABLE compaction_movements AS SELECT {} FROM main.stock_movements WHERE 0".format(_MOVEMENT_COLUMNS))
+    report = {"archived" : 0, "summaries" : 0}
+    try:
+        while True:
+            cursor.execute("DELETE FROM temp.compaction_movements")
+            cursor.execute("""INSERT INTO temp.compaction_movements
+                           SELECT {} FROM main.stock_movements
+                           WHERE status IN ('COMPLETED', 'CANCELLED') AND created_at < ?
+                           ORDER BY id LIMIT ?""".format(_MOVEMENT_COLUMNS), (_formatTimestamp(cutoff), chunk_size))
+            moved = cursor.rowcount
+            if moved <= 0:
+                break
+
+            # Step 1 -> copy to the archive. Commits across attached WAL databases are not atomic together,
+            # so this is committed on its own and is idempotent if a crash makes the chunk run again
+            cursor.execute("INSERT OR IGNORE INTO archive.stock_movements ({columns}) SELECT {columns} FROM temp.compaction_movements".format(columns = _MOVEMENT_COLUMNS))
+            conn.commit()
+
+            # Step 2 -> fold the chunk into the baselines, leave summary rows and remove it from the hot table
+            cursor.execute(_LEDGER_QUERY.format(movements = "temp.compaction_movements", snapshots = _NO_SNAPSHOTS, summary_filter = "",
+                                                location_filter = "", source_filter = "", pairs_source = "stock_baselines"))
+            baselines = cursor.fetchall()
+            cursor.executemany("""INSERT INTO stock_baselines (variant_id, location_id, amount, last_movement_id) VALUES (?, ?, ?, ?)
+                               ON CONFLICT (variant_id, location_id) DO UPDATE SET amount = excluded.amount, last_movement_id = excluded.last_movement_id""",
+                               [(variant, location, amount, last_id) for variant, location, amount, replayed, last_id in baselines if replayed])
+            # A snapshot older than compacted movements would take precedence over the baseline that now holds them
+            cursor.executemany("DELETE FROM stock_snapshots WHERE variant_id = ? AND location_id = ? AND last_movement_id < ?",
+                               [(variant, location, last_id) for variant, location, amount, replayed, last_id in baselines if replayed])
+            cursor.execute("""INSERT INTO stock_movement_summaries (period_type, period, variant_id, location_id, source_location_id, type, status, reason,
+                                                                 movement_count, total_amount, first_movement_id, last_movement_id)
+                           SELECT ?, strftime(?, created_at) AS bucket, variant_id, location_id, source_location_id, type, status, reason,
+                                  COUNT(*), SUM(change_amount), MIN(id), MAX(id)
+                           FROM temp.compaction_movements
+                           GROUP BY bucket, variant_id, location_id, source_location_id, type, status, reason""", (period, period_format))
+            report["summaries"] += cursor.rowcount
+            cursor.execute("DELETE FROM main.stock_movements WHERE id IN (SELECT id FROM temp.compaction_movements)")
+            conn.commit()
+            report["archived"] += moved
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        cursor.execute("DROP TABLE IF EXISTS temp.compaction_movements")
+    return report
+
+#### Reorder points and low stock alerts------------------------------------------
+# Only the (variant, location) rows a write touches are checked: their available amount (physical - reserved) is read
+# before and after the write, and crossing the reorder point queues a LOW_STOCK (dropped below) or RECOVERED
+# (back at or above) row in stock_alerts. Registered callbacks receive the new alerts once the transaction commits.
+StockAlert = namedtuple("StockAlert", ["id", "variant_id", "location_id", "type", "available_amount", "reorder_point", "reorder_quantity", "created_at", "acknowledged_at"])
+
+alert_logger = logging.getLogger("inventory.alerts")
+_alert_callbacks = []
+_pending_alerts = {}
+_pending_alerts_lock = threading.Lock()
+
+# callback(alert) is called with a StockAlert for every committed alert, on the thread that committed it
+def registerStockAlertCallback(callback):
+    _alert_callbacks.append(callback)
+    return callback
+
+def unregisterStockAlertCallback(callback):
+    if callback in _alert_callbacks:
+        _alert_callbacks.remove(callback)
+
+def _fireStockAlerts(conn):
+    with _pending_alerts_lock:
+        alerts = _pending_alerts.pop(id(conn), ())
+    for alert in alerts:
+        for callback in list(_alert_callbacks):
+            try:
+                callback(alert)
+            except Exception:
+                # A failing subscriber must not undo or hide a committed write, the alert stays in stock_alerts
+                alert_logger.exception("Stock alert callback %r failed for alert %s", callback, alert.id)
+
+# keep -> number of pending alerts to keep, for rolling back to a savepoint
+def _discardStockAlerts(conn, keep = 0):
+    with _pending_alerts_lock:
+        if keep:
+            del _pending_alerts.get(id(conn), [])[keep:]
+        else:
+            _pending_alerts.pop(id(conn), None)
+
+def _pendingStockAlertCount(conn):
+    with _pending_alerts_lock:
+        return len(_pending_alerts.get(id(conn), ()))
+
+# Returns {(variant, location) : (available_amount, reorder_point, reorder_quantity)} for the keys that have a reorder point
+def _reorderStateLogic(conn, keys):
+    keys = list(keys)
+    if not keys:
+        return {}
+    cursor = conn.cursor()
+    cursor.execute("""SELECT r.variant_id, r.location_id, IFNULL(h.physical_amount, 0) - IFNULL(h.reserved_amount, 0), r.reorder_point, r.reorder_quantity
+                   FROM json_each(?) k
+                   JOIN reorder_points r ON r.variant_id = json_extract(k.value, '$[0]') AND r.location_id = json_extract(k.value, '$[1]')
+                   LEFT JOIN has_variants h ON h.variant_id = r.variant_id AND h.location_id = r.location_id""",
+                   (json.dumps([list(key) for key in keys]),))
+    return {(row[0], row[1]) : row[2:] for row in cursor.fetchall()}
+
+def _emitStockAlertsLogic(conn, before, keys = None):
+    keys = list(before) if keys is None else keys
+    if not keys:
+        return []
+    after = _reorderStateLogic(conn, keys)
+    crossings = []
+    for key, (available, reorder_point, reorder_quantity) in after.items():
+        was_low = key in before and before[key][0] < before[key][1]
+        is_low = available < reorder_point
+        if is_low != was_low and (is_low or key in before):
+            crossings.append((key[0], key[1], "LOW_STOCK" if is_low else "RECOVERED", available, reorder_point, reorder_quantity))
+    if not crossings:
+        return []
+    cursor = conn.cursor()
+    alerts = []
+    for crossing in crossings:
+        cursor.execute("""INSERT INTO stock_alerts (variant_id, location_id, type, available_amount, reorder_point, reorder_quantity)
+                       VALUES (?, ?, ?, ?, ?, ?) RETURNING id, created_at""", crossing)
+        alert_id, created_at = cursor.fetchone()
+        alerts.append(StockAlert(alert_id, *crossing, created_at, None))
+    with _pending_alerts_lock:
+        _pending_alerts.setdefault(id(conn), []).extend(alerts)
+    return alerts
+
+def _setReorderPointLogic(conn, variant, location, reorder_point, reorder_quantity = None):
+    if reorder_point < 0:
+        raise ValueError("Reorder point can't be negative")
+    # Moving the threshold over the current available amount is a crossing as well
+    before = _reorderStateLogic(conn, [(variant, location)])
+    cursor = conn.cursor()
+    cursor.execute("""INSERT INTO reorder_points (variant_id, location_id, reorder_point, reorder_quantity) VALUES (?, ?, ?, ?)
+                   ON CONFLICT (variant_id, location_id) DO UPDATE SET reorder_point = excluded.reorder_point, reorder_quantity = excluded.reorder_quantity""",
+                   (variant, location, reorder_point, reorder_quantity))
+    return _emitStockAlertsLogic(conn, before, [(variant, location)])
+
+def _removeReorderPointLogic(conn, variant, location):
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM reorder_points WHERE variant_id = ? AND location_id = ?", (variant, location))
+    return cursor.rowcount > 0
+
+def _fetchStockAlertsLogic(conn, include_acknowledged = False, limit = 100):
+    cursor = conn.cursor()
+    cursor.execute("SELECT " + ", ".join(StockAlert._fields) + " FROM stock_alerts" +
+                   ("" if include_acknowledged else " WHERE acknowledged_at IS NULL") + " ORDER BY id LIMIT ?", (limit,))
+    return [StockAlert(*row) for row in cursor.fetchall()]
+
+def _acknowledgeStockAlertsLogic(conn, alert_ids):
+    cursor = conn.cursor()
+    cursor.execute("UPDATE stock_alerts SET acknowledged_at = CURRENT_TIMESTAMP WHERE acknowledged_at IS NULL AND id IN (SELECT value FROM json_each(?))",
+                   (json.dumps(list(alert_ids)),))
+    return cursor.rowcount
+
+#### Daily movement rollups and analytics--------------------------------------------
+# movement_daily_rollups is kept up to date by every path that moves a movement into or out of COMPLETED, keyed by
+# the day the movement was recorded. A transfer counts at both ends: units at each, net_amount + at the destination
+# and - at the source. An adjustment's units are the counted amount and its net_amount is 0, since it replaces stock.
+_ROLLUP_SIDES = """
+    WITH moved AS (
+        SELECT date(created_at) AS day, variant_id, location_id, source_location_id, type, reason, change_amount
+        FROM stock_movements WHERE {filter}),
+    sides AS (
+        SELECT day, variant_id, location_id, type, reason, change_amount AS units,
+               CASE type WHEN 'OUT' THEN - change_amount WHEN 'ADJUST' THEN 0 ELSE change_amount END AS net_amount
+        FROM moved
+        UNION ALL
+        SELECT day, variant_id, source_location_id, type, reason, change_amount, - change_amount
+        FROM moved WHERE type = 'TRANSFER')
+    """
+
+# sign is 1 for movements that just became COMPLETED and -1 for ones that stopped being COMPLETED
+def _rollupMovementsLogic(conn, movement_ids, sign = 1):
+    if not movement_ids:
+        return
+    cursor = conn.cursor()
+    cursor.execute(_ROLLUP_SIDES.format(filter = "id IN (SELECT value FROM json_each(:ids))") + """
+                   INSERT INTO movement_daily_rollups (day, variant_id, location_id, type, reason, movement_count, units, net_amount)
+                   SELECT day, variant_id, location_id, type, reason, :sign * COUNT(*), :sign * SUM(units), :sign * SUM(net_amount)
+                   FROM sides WHERE true GROUP BY day, variant_id, location_id, type, reason
+                   ON CONFLICT (day, variant_id, location_id, type, reason) DO UPDATE SET
+                       movement_count = movement_count + excluded.movement_count,
+                       units = units + excluded.units,
+                       net_amount = net_amount + excluded.net_amount""",
+                   {"ids" : json.dumps(list(movement_ids)), "sign" : sign})
+
+# Rebuilds the rollups from stock_movements, from the day of since on (or completely). Days whose movements were
+# already compacted into the archive are only kept when since is after them
+def _rebuildMovementRollupsLogic(conn, since = None):
+    day = _formatDay(since) if since is not None else None
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM movement_daily_rollups WHERE ? IS NULL OR day >= ?", (day, day))
+    cursor.execute(_ROLLUP_SIDES.format(filter = "status = 'COMPLETED' AND (:day IS NULL OR created_at >= :day)") + """
+                   INSERT INTO movement_daily_rollups (day, variant_id, location_id, type, reason, movement_count, units, net_amount)
+                   SELECT day, variant_id, location_id, type, reason, COUNT(*), SUM(units), SUM(net_amount)
+                   FROM sides GROUP BY day, variant_id, location_id, type, reason""", {"day" : day})
+    return cursor.rowcount
+
+def _formatDay(value):
+    return value.strftime('%Y-%m-%d') if hasattr(value, "strftime") else str(value)[:10]
+
+ANALYTICS_GROUPS = {
+    'category' : ("p.category", "JOIN variants v ON v.id = r.variant_id JOIN products p ON p.id = v.product_id"),
+    'product' : ("v.product_id", "JOIN variants v ON v.id = r.variant_id"),
+    'variant' : ("r.variant_id", ""),
+    'location' : ("r.location_id", ""),
+}
+
+# Returns [{"key", "period", "movement_count", "units", "net_amount"}, ...] for completed movements between start and
+# end (inclusive days), grouped by category, product, variant or location and optionally by period (day, week, month,
+# year -> same keys as COMPACTION_PERIODS), filtered by type, reason and location
+def _movementAnalyticsLogic(conn, start, end, by = 'category', period = None, type = None, reason = None, location = None):
+    if by not in ANALYTICS_GROUPS:
+        raise ValueError("Unknown analytics grouping: {}".format(by))
+    key, joins = ANALYTICS_GROUPS[by]
+    bucket = "strftime('{}', r.day)".format(COMPACTION_PERIODS[period]) if period is not None else "NULL"
     cursor = conn.cursor()
-    cursor.execute("SUM (m.change_amount) FROM stock_movements AS m WHERE variant_id = ? AND location_id = ?", (variant, location))
-    amount = cursor.fetchone()[0]
-    cursor.execute("UPDATE has_products SET physical_amount = ? WHERE variant_id = ? AND location_id = ?", (amount, variant, location))
-    return amount
\ No newline at end of file
+    cursor.execute("""SELECT {key}, {bucket} AS bucket, SUM(r.movement_count), SUM(r.units), SUM(r.net_amount)
+                   FROM movement_daily_rollups r {joins}
+                   WHERE r.day BETWEEN :start AND :end
+                   AND (:type IS NULL OR r.type = :type)
+                   AND (:reason IS NULL OR r.reason = :reason)
+                   AND (:location IS NULL OR r.location_id = :location)
+                   GROUP BY 1, 2 HAVING SUM(r.movement_count) != 0
+                   ORDER BY 2, 1""".format(key = key, bucket = bucket, joins = joins),
+                   {"start" : _formatDay(start), "end" : _formatDay(end), "type" : type, "reason" : reason, "location" : location})
+    return [{"key" : row[0], "period" : row[1], "movement_count" : row[2], "units" : row[3], "net_amount" : row[4]} for row in cursor.fetchall()]
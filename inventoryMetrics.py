@@ -0,0 +1,174 @@
+import logging
+import re
+import threading
+from bisect import bisect_left
+from collections import deque
+from time import perf_counter
+
+# In-memory metrics for the inventory database: latency histograms and counters keyed by name and labels,
+# a bounded slow-query log, and export as a dict snapshot or in the Prometheus text format.
+# inventoryDB.enableInstrumentation() feeds it from wrap_transaction and sqlite3's trace callback.
+
+# Upper bounds of the latency buckets in seconds (the +Inf bucket is implicit)
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+slow_query_logger = logging.getLogger("inventory.slow_queries")
+
+class LatencyHistogram:
+    def __init__(self, buckets = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    # Estimated from the buckets -> upper bound of the bucket holding the quantile
+    def quantile(self, fraction):
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (self.max,), self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count" : self.count,
+            "sum" : self.sum,
+            "max" : self.max,
+            "p50" : self.quantile(0.50),
+            "p95" : self.quantile(0.95),
+            "p99" : self.quantile(0.99),
+            "buckets" : dict(zip([str(bound) for bound in self.buckets] + ["+Inf"], self.counts)),
+        }
+
+class MetricsRegistry:
+    def __init__(self, slow_query_threshold = 0.1, slow_log_size = 100, buckets = DEFAULT_BUCKETS):
+        self.slow_query_threshold = slow_query_threshold
+        self.buckets = buckets
+        self.histograms = {}
+        self.counters = {}
+        self.slow_queries = deque(maxlen = slow_log_size)
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram(self.buckets)
+            histogram.observe(seconds)
+
+    def increment(self, name, amount = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    # Records a statement or transaction in the slow-query log when it took longer than the threshold
+    def recordSlow(self, kind, text, seconds, **labels):
+        if self.slow_query_threshold is None or seconds < self.slow_query_threshold:
+            return
+        entry = dict(labels, kind = kind, text = text, seconds = seconds)
+        with self._lock:
+            self.slow_queries.append(entry)
+        slow_query_logger.warning("Slow %s (%.3fs): %s", kind, seconds, text)
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.slow_queries.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "histograms" : [dict(name = name, labels = dict(labels), **histogram.snapshot()) for (name, labels), histogram in self.histograms.items()],
+                "counters" : [{"name" : name, "labels" : dict(labels), "value" : value} for (name, labels), value in self.counters.items()],
+                "slow_queries" : list(self.slow_queries),
+            }
+
+    def toPrometheus(self):
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, labels in self.counters}):
+                lines.append("# TYPE {} counter".format(name))
+                for (counter_name, labels), value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        lines.append("{}{} {}".format(name, _formatLabels(labels), value))
+            for name in sorted({name for name, labels in self.histograms}):
+                lines.append("# TYPE {} histogram".format(name))
+                for (histogram_name, labels), histogram in sorted(self.histograms.items(), key = lambda item: item[0]):
+                    if histogram_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip([repr(bound) for bound in histogram.buckets] + ["+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append("{}_bucket{} {}".format(name, _formatLabels(labels + (("le", bound),)), cumulative))
+                    lines.append("{}_sum{} {}".format(name, _formatLabels(labels), repr(histogram.sum)))
+                    lines.append("{}_count{} {}".format(name, _formatLabels(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+def _formatLabels(labels):
+    if not labels:
+        return ""
+    escaped = ['{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for key, value in labels]
+    return "{" + ",".join(escaped) + "}"
+
+_WHITESPACE = re.compile(r"\s+")
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?(?![\w.])")
+
+# The trace callback sees statements with their parameters expanded -> literals are put back to ? and whitespace
+# is collapsed, so the same statement always gets the same label and no values end up in the metrics
+def normaliseStatement(statement, max_length = 200):
+    statement = _STRING_LITERAL.sub("?", statement)
+    statement = _NUMBER_LITERAL.sub("?", statement)
+    statement = _WHITESPACE.sub(" ", statement).strip()
+    return statement if len(statement) <= max_length else statement[:max_length] + "..."
+
+# SQLite VM instructions between two progress() ticks of a StatementTracer -> the precision of its statement times
+TRACE_INSTRUCTIONS = 100
+
+# sqlite3 trace callback timing each statement from the moment SQLite starts it until the last progress() tick it
+# produced (the connection's progress handler calls it every TRACE_INSTRUCTIONS VM instructions, including while rows
+# are fetched). Python work between two statements is therefore not charged to either of them; sql_seconds adds up
+# the statement times so the caller can report the Python side as the rest of the transaction.
+# Statements FTS5 runs on its shadow tables ("-- INSERT INTO ?.? ...") happen inside the outer statement and are skipped
+class StatementTracer:
+    def __init__(self, registry, function):
+        self.registry = registry
+        self.function = function
+        self.sql_seconds = 0.0
+        self._statement = None
+        self._started = 0.0
+        self._last_progress = 0.0
+
+    def __call__(self, statement):
+        if statement.startswith("-- "):
+            return
+        self.close()
+        self._statement = statement
+        self._started = self._last_progress = perf_counter()
+
+    def progress(self):
+        self._last_progress = perf_counter()
+        return False
+
+    def close(self):
+        if self._statement is None:
+            return
+        seconds = self._last_progress - self._started
+        text = normaliseStatement(self._statement)
+        self._statement = None
+        self.sql_seconds += seconds
+        self.registry.observe("inventory_statement_seconds", seconds, statement = text)
+        self.registry.recordSlow("statement", text, seconds, function = self.function)
@@ -0,0 +1,333 @@
+import re
+import sqlite3
+import threading
+
+import inventoryDB as iDB
+
+# Location-sharded storage. The catalog (products, variants, prices, reviews, locations) stays in one shared
+# database, while has_variants, the movement ledger and everything derived from it are split into one file per
+# group of locations. Every shard connection ATTACHes the catalog, so the inventoryDB functions run unchanged on it,
+# and writes to different shards take different writer locks -> stores in separate shards (or separate processes)
+# write in parallel.
+#
+#   inventory = ShardedInventory('catalog.db', {'north' : 'north.db', 'south' : 'south.db'})
+#   store = inventory.addLocation('Store 1', False, shard = 'north')
+#   iDB.addMovementOut(inventory.forLocation(store), variant, store, 1, iDB.MovementOutReason.SALE, iDB.MovementStatus.COMPLETED)
+#   inventory.federated().execute("SELECT * FROM v_inventory_summary WHERE variant_id = ?", (variant,))
+#
+# Catalog writes and reads that don't need stock go through inventory.catalog. The catalog holds no stock, so it has
+# no v_inventory_summary: searchCatalog and the other reads of that view run on inventory.federated()
+# (inventory.searchCatalog() does this), while checkAvailability runs on the location's shard.
+# Foreign keys can't point into another file, so they are off on the shards and location/variant ids are only
+# checked by the callers. Transfers between shards use a two-phase journal in the catalog (see transfer()).
+# A location can't be moved to another shard once assigned.
+
+SHARD_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+def initCatalog(path = 'catalog.db', **pragmas):
+    conn = sqlite3.connect(path, check_same_thread = False)
+    iDB.configureConnection(conn, **pragmas)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN;")
+        iDB._createCatalogSchemaLogic(conn)
+        cursor.execute('''
+                CREATE TABLE IF NOT EXISTS location_shards (
+                    location_id INTEGER PRIMARY KEY,
+                    shard VARCHAR(50) NOT NULL,
+
+                    FOREIGN KEY (location_id) REFERENCES locations(id)
+                    )
+                    ''')
+        # Journal of transfers between shards -> PREPARED, then SHIPPED once the source shard has committed its OUT
+        # movement, then RECEIVED once the destination shard has committed its IN movement (or ABORTED)
+        cursor.execute('''
+                CREATE TABLE IF NOT EXISTS shard_transfers (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    variant_id INTEGER NOT NULL,
+                    location_id INTEGER NOT NULL,
+                    source_location_id INTEGER NOT NULL,
+                    amount INTEGER NOT NULL,
+                    reason VARCHAR(50),
+                    status VARCHAR(50) NOT NULL,
+                    source_shard VARCHAR(50) NOT NULL,
+                    destination_shard VARCHAR(50) NOT NULL,
+                    source_movement_id INTEGER,
+                    destination_movement_id INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+                    FOREIGN KEY (variant_id) REFERENCES variants(id),
+                    FOREIGN KEY (location_id) REFERENCES locations(id),
+                    FOREIGN KEY (source_location_id) REFERENCES locations(id)
+                    )
+                    ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_shard_transfer_open ON shard_transfers(updated_at) WHERE status IN ('PREPARED', 'SHIPPED');")
+        conn.commit()
+        return conn
+    except sqlite3.Error as e:
+        conn.rollback()
+        raise e
+
+def openShard(path, catalog_path, **pragmas):
+    conn = sqlite3.connect(path, check_same_thread = False)
+    iDB.configureConnection(conn, **pragmas)
+    conn.execute("PRAGMA foreign_keys = OFF;")
+    conn.execute("ATTACH DATABASE ? AS catalog", (catalog_path,))
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN;")
+        iDB._createStockSchemaLogic(conn)
+        # Which shard transfers this shard has already applied -> makes both halves of a transfer idempotent
+        cursor.execute('''
+                CREATE TABLE IF NOT EXISTS shard_transfer_log (
+                    transfer_id INTEGER PRIMARY KEY,
+                    movement_id INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
+                    ''')
+        # The catalog tables are in the attached database, which only a temporary view can join
+        iDB._createSummaryViewLogic(conn, temp = True)
+        conn.commit()
+        return conn
+    except sqlite3.Error as e:
+        conn.rollback()
+        raise e
+
+# One instance per process. Each connection is meant to be used by one thread at a time
+class ShardedInventory:
+    def __init__(self, catalog_path, shards, default_shard = None, **pragmas):
+        for name in shards:
+            if not SHARD_NAME.match(name):
+                raise ValueError("Invalid shard name {!r}".format(name))
+        if default_shard is not None and default_shard not in shards:
+            raise ValueError("Unknown shard {!r}".format(default_shard))
+        self.catalog_path = catalog_path
+        self.shard_paths = dict(shards)
+        self.default_shard = default_shard
+        self.pragmas = pragmas
+        self.catalog = initCatalog(catalog_path, **pragmas)
+        self._shards = {}
+        self._routes = {}
+        self._federated = None
+        self._lock = threading.Lock()
+
+    #### Routing------------------------------------------------------------------
+    def shard(self, name):
+        with self._lock:
+            conn = self._shards.get(name)
+            if conn is None:
+                if name not in self.shard_paths:
+                    raise ValueError("Unknown shard {!r}".format(name))
+                conn = self._shards[name] = openShard(self.shard_paths[name], self.catalog_path, **self.pragmas)
+            return conn
+
+    def shardFor(self, location):
+        name = self._routes.get(location)
+        if name is None:
+            cursor = self.catalog.cursor()
+            cursor.execute("SELECT shard FROM location_shards WHERE location_id = ?", (location,))
+            row = cursor.fetchone()
+            if row is None and self.default_shard is None:
+                raise ValueError("Location {} is not assigned to a shard".format(location))
+            name = row[0] if row is not None else self.default_shard
+            self._routes[location] = name
+        return name
+
+    # Connection of the shard holding the location -> pass it to the inventoryDB movement and stock functions
+    def forLocation(self, location):
+        return self.shard(self.shardFor(location))
+
+    def assignLocation(self, location, shard):
+        if shard not in self.shard_paths:
+            raise ValueError("Unknown shard {!r}".format(shard))
+        cursor = self.catalog.cursor()
+        try:
+            cursor.execute("INSERT INTO location_shards (location_id, shard) VALUES (?, ?) ON CONFLICT (location_id) DO NOTHING", (location, shard))
+            cursor.execute("SELECT shard FROM location_shards WHERE location_id = ?", (location,))
+            current = cursor.fetchone()[0]
+            if current != shard:
+                raise ValueError("Location {} already belongs to shard {!r}".format(location, current))
+            self.catalog.commit()
+        except Exception as e:
+            self.catalog.rollback()
+            raise e
+        self._routes[location] = shard
+
+    def addLocation(self, location_name, is_storage, address = '', shard = None):
+        location = iDB.addLocation(self.catalog, location_name, is_storage, address)
+        self.assignLocation(location, shard or self.default_shard)
+        return location
+
+    #### Transfers----------------------------------------------------------------
+    # Moves amount of variant from source_location to location and returns
+    # {"transfer_id", "source_movement_id", "destination_movement_id"} (transfer_id is None within one shard).
+    # Across shards the OUT and IN halves commit separately, driven by the shard_transfers journal: a failure
+    # between them leaves the transfer PREPARED or SHIPPED for recoverTransfers() to finish.
+    def transfer(self, variant, location, source_location, amount, reason = iDB.MovementTransferReason.INTERNAL):
+        source_shard = self.shardFor(source_location)
+        destination_shard = self.shardFor(location)
+        if source_shard == destination_shard:
+            conn = self.shard(source_shard)
+            movement_id = self._localTransfer(conn, variant, location, source_location, amount, reason)
+            return {"transfer_id" : None, "source_movement_id" : movement_id, "destination_movement_id" : movement_id}
+
+        cursor = self.catalog.cursor()
+        cursor.execute("""INSERT INTO shard_transfers (variant_id, location_id, source_location_id, amount, reason, status, source_shard, destination_shard)
+                       VALUES (?, ?, ?, ?, ?, 'PREPARED', ?, ?) RETURNING id""",
+                       (variant, location, source_location, amount, reason, source_shard, destination_shard))
+        transfer_id = cursor.fetchone()[0]
+        self.catalog.commit()
+        return self._completeTransfer(transfer_id)
+
+    # Finishes cross-shard transfers left PREPARED or SHIPPED for longer than older_than seconds. Both halves are
+    # idempotent, so this is safe to repeat; the age limit keeps it away from transfers still in flight elsewhere.
+    # A PREPARED transfer whose OUT half never committed is rolled forward too, unless the stock is gone (-> ABORTED)
+    def recoverTransfers(self, older_than = 60):
+        cursor = self.catalog.cursor()
+        cursor.execute("""SELECT id FROM shard_transfers WHERE status IN ('PREPARED', 'SHIPPED')
+                       AND updated_at <= datetime('now', ?) ORDER BY id""", ("-{} seconds".format(int(older_than)),))
+        recovered = []
+        for (transfer_id,) in cursor.fetchall():
+            try:
+                recovered.append(self._completeTransfer(transfer_id))
+            except iDB.InsufficientStockError:
+                continue
+        return recovered
+
+    def fetchTransfer(self, transfer_id):
+        cursor = self.catalog.cursor()
+        cursor.execute("""SELECT id, variant_id, location_id, source_location_id, amount, reason, status, source_shard, destination_shard,
+                       source_movement_id, destination_movement_id, created_at, updated_at FROM shard_transfers WHERE id = ?""", (transfer_id,))
+        row = cursor.fetchone()
+        if row is None:
+            raise ValueError("No shard transfer with id {}".format(transfer_id))
+        keys = ["id", "variant", "location", "source_location", "amount", "reason", "status", "source_shard", "destination_shard",
+                "source_movement_id", "destination_movement_id", "created_at", "updated_at"]
+        return dict(zip(keys, row))
+
+    def _completeTransfer(self, transfer_id):
+        transfer = self.fetchTransfer(transfer_id)
+        if transfer["status"] == "PREPARED":
+            try:
+                transfer["source_movement_id"] = self._applyTransferHalf(
+                    self.shard(transfer["source_shard"]), transfer_id, transfer["variant"], transfer["source_location"], transfer["amount"], outgoing = True)
+            except iDB.InsufficientStockError as e:
+                self._setTransferStatus(transfer_id, "ABORTED", "PREPARED")
+                raise e
+            self._setTransferStatus(transfer_id, "SHIPPED", "PREPARED", source_movement_id = transfer["source_movement_id"])
+            transfer["status"] = "SHIPPED"
+        if transfer["status"] == "SHIPPED":
+            transfer["destination_movement_id"] = self._applyTransferHalf(
+                self.shard(transfer["destination_shard"]), transfer_id, transfer["variant"], transfer["location"], transfer["amount"], outgoing = False)
+            self._setTransferStatus(transfer_id, "RECEIVED", "SHIPPED", destination_movement_id = transfer["destination_movement_id"])
+        return {"transfer_id" : transfer_id, "source_movement_id" : transfer["source_movement_id"], "destination_movement_id" : transfer["destination_movement_id"]}
+
+    def _setTransferStatus(self, transfer_id, status, expected, **movement_ids):
+        assignments = "".join(", {} = :{}".format(column, column) for column in movement_ids)
+        cursor = self.catalog.cursor()
+        cursor.execute("UPDATE shard_transfers SET status = :status, updated_at = CURRENT_TIMESTAMP" + assignments + " WHERE id = :id AND status = :expected",
+                       dict(movement_ids, status = status, id = transfer_id, expected = expected))
+        self.catalog.commit()
+
+    # One half of a cross-shard transfer in a single shard transaction. Claiming the transfer id in shard_transfer_log
+    # comes first, so a half that already committed is never applied twice
+    def _applyTransferHalf(self, conn, transfer_id, variant, location, amount, outgoing):
+        cursor = conn.cursor()
+        try:
+            cursor.execute("INSERT INTO shard_transfer_log (transfer_id) VALUES (?) ON CONFLICT (transfer_id) DO NOTHING", (transfer_id,))
+            if cursor.rowcount == 0:
+                cursor.execute("SELECT movement_id FROM shard_transfer_log WHERE transfer_id = ?", (transfer_id,))
+                movement_id = cursor.fetchone()[0]
+                conn.commit()
+                return movement_id
+            if outgoing:
+                short = iDB._shortLinesLogic(conn, [(variant, location, amount)])
+                if short:
+                    raise iDB.InsufficientStockError(short)
+                movement_id = iDB._addMovementLogic(conn, variant, location, None, amount, iDB.MovementType.OUT,
+                                                    iDB.MovementOutReason.TRANSFER, iDB.MovementStatus.COMPLETED)
+                iDB._completedMovementLogic(conn, variant, location, - amount)
+            else:
+                movement_id = iDB._addMovementLogic(conn, variant, location, None, amount, iDB.MovementType.IN,
+                                                    iDB.MovementInReason.TRANSFER, iDB.MovementStatus.COMPLETED)
+                iDB._completedMovementLogic(conn, variant, location, amount)
+            iDB._rollupMovementsLogic(conn, [movement_id])
+            cursor.execute("UPDATE shard_transfer_log SET movement_id = ? WHERE transfer_id = ?", (movement_id, transfer_id))
+            conn.commit()
+            iDB._fireStockAlerts(conn)
+            return movement_id
+        except Exception as e:
+            conn.rollback()
+            iDB._discardStockAlerts(conn)
+            raise e
+
+    def _localTransfer(self, conn, variant, location, source_location, amount, reason):
+        cursor = conn.cursor()
+        try:
+            short = iDB._shortLinesLogic(conn, [(variant, source_location, amount)])
+            if short:
+                raise iDB.InsufficientStockError(short)
+            movement_id = iDB._addMovementLogic(conn, variant, location, source_location, amount, iDB.MovementType.TRANSFER, reason, iDB.MovementStatus.COMPLETED)
+            iDB._completedMovementLogic(conn, variant, location, amount)
+            iDB._completedMovementLogic(conn, variant, source_location, - amount)
+            iDB._rollupMovementsLogic(conn, [movement_id])
+            conn.commit()
+            iDB._fireStockAlerts(conn)
+            return movement_id
+        except Exception as e:
+            conn.rollback()
+            iDB._discardStockAlerts(conn)
+            raise e
+
+    #### Federated reads----------------------------------------------------------
+    # Read-only connection on the catalog with every shard ATTACHed and a temporary v_inventory_summary over all of
+    # them (with an extra shard column). SQLite limits attached databases (10 by default), which caps the shard count
+    def federated(self):
+        with self._lock:
+            if self._federated is None:
+                # Opening every shard first makes sure their tables exist before the view is created
+                for name, path in self.shard_paths.items():
+                    if name not in self._shards:
+                        self._shards[name] = openShard(path, self.catalog_path, **self.pragmas)
+                conn = sqlite3.connect(self.catalog_path, check_same_thread = False)
+                iDB.configureConnection(conn, **self.pragmas)
+                for name, path in self.shard_paths.items():
+                    conn.execute("ATTACH DATABASE ? AS shard_{}".format(name), (path,))
+                stock = " UNION ALL ".join(
+                    "SELECT '{0}' AS shard, variant_id, location_id, physical_amount, reserved_amount FROM shard_{0}.has_variants".format(name)
+                    for name in self.shard_paths)
+                conn.execute('''
+                        CREATE TEMP VIEW v_inventory_summary AS
+                        SELECT
+                            h.variant_id AS variant_id,
+                            p.name AS product_name,
+                            v.description AS description,
+                            v.current_price as current_price,
+                            h.location_id AS location_id,
+                            l.location_name AS location_name,
+                            h.physical_amount AS physical_amount,
+                            h.reserved_amount AS reserved_amount,
+                            h.physical_amount - h.reserved_amount AS available_amount,
+                            h.shard AS shard
+
+                        FROM variants v
+                        JOIN products p ON v.product_id = p.id
+                        JOIN ({}) h ON v.id = h.variant_id
+                        JOIN locations l ON h.location_id = l.id
+                            '''.format(stock))
+                # Read-only from here on -> the temporary view had to be created first
+                conn.execute("PRAGMA query_only = ON;")
+                self._federated = conn
+            return self._federated
+
+    # Catalog search with availability summed over every shard
+    def searchCatalog(self, text, page = 0, page_size = 20, in_stock = False):
+        return iDB.searchCatalog(self.federated(), text, page, page_size, in_stock)
+
+    def close(self):
+        with self._lock:
+            for conn in list(self._shards.values()) + [self._federated, self.catalog]:
+                if conn is not None:
+                    conn.close()
+            self._shards.clear()
+            self._federated = None
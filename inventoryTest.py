@@ -1,7 +1,7 @@
 import inventoryDB as iDB
 
-def populate():
-    conn = iDB.initDatabase()
+def populate(conn = None):
+    conn = conn or iDB.initDatabase()
     product1 = iDB.addProduct(conn, "Nike Air Max", "Footwear")
     product2 = iDB.addProduct(conn, "Adidas Rainproof Jacket", "Jackets")
     product3 = iDB.addProduct(conn, "Ippon Karate Gloves", "Sports accessories")
@@ -27,6 +27,4 @@ def populate():
 
     iDB.addReview(conn, variant3_2, "Marvellous!", "Charlie", 5)
 
-    
-
-
+    return conn
@@ -0,0 +1,130 @@
+import numpy as np
+
+# Pricing trend analytics over price_history. Series are loaded straight from the cursor into NumPy arrays
+# and every statistic is computed with array operations, so there is no Python loop per price row.
+#
+# A series is (times, prices) or, for several variants at once, (variant_ids, times, prices) sorted by
+# variant then time. The grouped functions take the variant_ids array as groups and never mix variants.
+
+PERIODS = {"D" : "datetime64[D]", "W" : "datetime64[W]", "M" : "datetime64[M]", "Y" : "datetime64[Y]"}
+
+#### Loading series---------------------------------------------------------------
+_SERIES_COLUMNS = "p.variant_id, CAST(strftime('%s', p.start_date) AS INTEGER), p.price"
+_SERIES_DTYPE = np.dtype([("variant_id", np.int64), ("time", np.int64), ("price", np.float64)])
+
+def _loadSeries(conn, where, params):
+    cursor = conn.cursor()
+    cursor.execute("SELECT " + _SERIES_COLUMNS + " FROM price_history p " + where + " ORDER BY p.variant_id, p.start_date, p.id", params)
+    rows = np.fromiter(cursor, dtype = _SERIES_DTYPE)
+    return rows["variant_id"], rows["time"].astype("datetime64[s]"), rows["price"]
+
+def loadPriceSeries(conn, variant):
+    variant_ids, times, prices = _loadSeries(conn, "WHERE p.variant_id = ?", (variant,))
+    return times, prices
+
+def loadCategoryPriceSeries(conn, category):
+    return _loadSeries(conn, "JOIN variants v ON v.id = p.variant_id JOIN products pr ON pr.id = v.product_id WHERE pr.category = ?", (category,))
+
+def loadProductPriceSeries(conn, product):
+    return _loadSeries(conn, "JOIN variants v ON v.id = p.variant_id WHERE v.product_id = ?", (product,))
+
+#### Helpers for grouped arrays---------------------------------------------------
+def _groupStarts(groups, length):
+    # Boolean mask marking the first element of every group (the whole array is one group when groups is None)
+    starts = np.zeros(length, dtype = bool)
+    if length:
+        starts[0] = True
+        if groups is not None:
+            starts[1:] = groups[1:] != groups[:-1]
+    return starts
+
+def _positionInGroup(groups, length):
+    starts = _groupStarts(groups, length)
+    start_index = np.maximum.accumulate(np.where(starts, np.arange(length), 0))
+    return np.arange(length) - start_index
+
+#### Vectorized statistics--------------------------------------------------------
+# Price in effect at each of the given times (NaN before the first price), for a single series
+def priceAsOf(times, prices, at):
+    at = np.asarray(at, dtype = "datetime64[s]")
+    if len(prices) == 0:
+        return np.full(at.shape, np.nan)
+    index = np.searchsorted(times, at, side = "right") - 1
+    result = np.where(index >= 0, prices[np.maximum(index, 0)], np.nan)
+    return result
+
+# Turns an event series into one price per period (the price in effect at the end of each period), forward filled
+def resample(times, prices, period = "D", start = None, end = None):
+    unit = PERIODS[period]
+    if len(times) == 0 and (start is None or end is None):
+        return np.array([], dtype = unit), np.array([], dtype = np.float64)
+    first = np.datetime64(start, "s") if start is not None else times[0]
+    last = np.datetime64(end, "s") if end is not None else times[-1]
+    period_starts = np.arange(first.astype(unit), last.astype(unit) + 1)
+    period_ends = (period_starts + 1).astype("datetime64[s]") - np.timedelta64(1, "s")
+    return period_starts, priceAsOf(times, prices, period_ends)
+
+def movingAverage(prices, window, groups = None):
+    prices = np.asarray(prices, dtype = np.float64)
+    sums = np.cumsum(prices)
+    averages = np.empty_like(prices)
+    averages[:window] = sums[:window]
+    averages[window:] = sums[window:] - sums[:-window]
+    averages /= window
+    # Windows reaching back into the previous group (or before the series) are incomplete
+    averages[_positionInGroup(groups, len(prices)) < window - 1] = np.nan
+    return averages
+
+def percentChange(prices, groups = None):
+    prices = np.asarray(prices, dtype = np.float64)
+    changes = np.full_like(prices, np.nan)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        changes[1:] = prices[1:] / prices[:-1] - 1
+    changes[_groupStarts(groups, len(prices))] = np.nan
+    return changes
+
+# Per (group, period) statistics of an event series:
+# returns a dict of arrays with group, period, count, mean, last, change (last vs previous period's last) and volatility
+# (standard deviation of the percent changes that happened within the period)
+def periodStats(times, prices, period = "M", groups = None):
+    prices = np.asarray(prices, dtype = np.float64)
+    length = len(prices)
+    groups = np.zeros(length, dtype = np.int64) if groups is None else np.asarray(groups)
+    periods = times.astype(PERIODS[period])
+
+    keys = np.rec.fromarrays([groups, periods.astype(np.int64)])
+    unique_keys, inverse = np.unique(keys, return_inverse = True)
+    bucket_count = len(unique_keys)
+
+    counts = np.bincount(inverse, minlength = bucket_count)
+    means = np.bincount(inverse, weights = prices, minlength = bucket_count) / counts
+
+    # Input is sorted by group and time, so the last row of each bucket is the last price of the period
+    last_index = np.zeros(bucket_count, dtype = np.int64)
+    np.maximum.at(last_index, inverse, np.arange(length))
+    last = prices[last_index]
+
+    bucket_groups = unique_keys.f0
+    change = np.full(bucket_count, np.nan)
+    same_group = bucket_groups[1:] == bucket_groups[:-1]
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        change[1:] = np.where(same_group, last[1:] / last[:-1] - 1, np.nan)
+
+    changes = percentChange(prices, groups)
+    valid = ~np.isnan(changes)
+    change_counts = np.bincount(inverse[valid], minlength = bucket_count)
+    change_sums = np.bincount(inverse[valid], weights = changes[valid], minlength = bucket_count)
+    change_squares = np.bincount(inverse[valid], weights = changes[valid] ** 2, minlength = bucket_count)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        change_means = change_sums / change_counts
+        volatility = np.sqrt(np.maximum(change_squares / change_counts - change_means ** 2, 0))
+
+    return {
+        "group" : bucket_groups,
+        "period" : unique_keys.f1.astype(PERIODS[period]),
+        "count" : counts,
+        "mean" : means,
+        "last" : last,
+        "change" : change,
+        "volatility" : volatility,
+    }
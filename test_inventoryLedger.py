@@ -0,0 +1,173 @@
+import random
+import threading
+
+import pytest
+
+import inventoryDB as iDB
+
+# Ledger invariants -> physical_amount must always equal what recalculating from stock_movements gives, with or without
+# snapshots, baselines and compaction in between
+@pytest.fixture
+def conn(tmp_path):
+    conn = iDB.initDatabase(str(tmp_path / "inventory.db"))
+    yield conn
+    conn.close()
+
+def addStock(conn, locations = 2, variants = 1):
+    product = iDB.addProduct(conn, "Nike Air Max", "Footwear")
+    variant_ids = [iDB.addVariant(conn, product, "Size {}".format(38 + index)) for index in range(variants)]
+    location_ids = [iDB.addLocation(conn, "Location {}".format(index), True) for index in range(locations)]
+    return variant_ids, location_ids
+
+def physicalAmount(conn, variant, location):
+    row = conn.execute("SELECT physical_amount FROM has_variants WHERE variant_id = ? AND location_id = ?", (variant, location)).fetchone()
+    return row[0] if row else 0
+
+def lastMovementId(conn):
+    return conn.execute("SELECT MAX(id) FROM stock_movements").fetchone()[0]
+
+def test_late_completion_before_adjust_is_counted_by_it(conn):
+    (variant,), (location, other) = addStock(conn)
+    iDB.addMovementIn(conn, variant, location, 10, iDB.MovementInReason.RESTOCK, iDB.MovementStatus.PENDING)
+    pending_id = lastMovementId(conn)
+    iDB.addMovementAdjust(conn, variant, location, 50, iDB.MovementAdjustReason.CORRECTION)
+    iDB.takeStockSnapshots(conn)
+    iDB.updatedMovementIn(conn, pending_id, iDB.MovementStatus.COMPLETED)
+
+    assert physicalAmount(conn, variant, location) == 50
+    assert iDB.recalculatePhysicalAmount(conn, variant, location) == 50
+    conn.execute("DELETE FROM stock_snapshots")
+    assert iDB.recalculatePhysicalAmount(conn, variant, location) == 50
+    assert iDB.recalculateAllPhysicalAmounts(conn) == []
+
+def test_random_movements_never_drift(conn):
+    rng = random.Random(8)
+    variants, locations = addStock(conn, locations = 3, variants = 3)
+    open_movements = []
+    adjusts = []
+    for step in range(400):
+        variant = rng.choice(variants)
+        location, source = rng.sample(locations, 2)
+        amount = rng.randint(1, 20)
+        status = rng.choice([iDB.MovementStatus.COMPLETED, iDB.MovementStatus.PENDING])
+        action = rng.random()
+        if action < 0.3:
+            iDB.addMovementIn(conn, variant, location, amount, iDB.MovementInReason.RESTOCK, status)
+            open_movements.append((lastMovementId(conn), iDB.updatedMovementIn))
+        elif action < 0.5:
+            iDB.addMovementOut(conn, variant, location, amount, iDB.MovementOutReason.SALE, status)
+            open_movements.append((lastMovementId(conn), iDB.updatedMovementOut))
+        elif action < 0.65:
+            transfer_status = rng.choice([iDB.MovementStatus.COMPLETED, iDB.MovementStatus.IN_TRANSIT])
+            iDB.addMovementTransfer(conn, variant, location, source, amount, iDB.MovementTransferReason.INTERNAL, transfer_status)
+            open_movements.append((lastMovementId(conn), iDB.updatedMovementTransfer))
+        elif action < 0.72:
+            iDB.addMovementAdjust(conn, variant, location, rng.randint(0, 100), iDB.MovementAdjustReason.CORRECTION)
+            adjusts.append(lastMovementId(conn))
+        elif action < 0.9 and open_movements:
+            movement_id, update = open_movements.pop(rng.randrange(len(open_movements)))
+            update(conn, movement_id, rng.choice([iDB.MovementStatus.COMPLETED, iDB.MovementStatus.CANCELLED]))
+        elif action < 0.95:
+            iDB.takeStockSnapshots(conn)
+        elif adjusts:
+            iDB.cancelMovementAdjust(conn, adjusts.pop(rng.randrange(len(adjusts))))
+        if step % 50 == 0:
+            assert iDB.recalculateAllPhysicalAmounts(conn) == []
+            # The single pair path seeks past the snapshot instead of running the full ledger query
+            for pair_variant in variants:
+                for pair_location in locations:
+                    physical = physicalAmount(conn, pair_variant, pair_location)
+                    assert iDB.recalculatePhysicalAmount(conn, pair_variant, pair_location) == physical
+    assert iDB.recalculateAllPhysicalAmounts(conn) == []
+    conn.execute("DELETE FROM stock_snapshots")
+    assert iDB.recalculateAllPhysicalAmounts(conn) == []
+
+def test_compaction_keeps_movements_newer_than_snapshot(conn, tmp_path):
+    (variant,), (location, other) = addStock(conn)
+    iDB.addMovementIn(conn, variant, location, 10, iDB.MovementInReason.RESTOCK, iDB.MovementStatus.COMPLETED)
+    iDB.takeStockSnapshots(conn)
+    iDB.addMovementIn(conn, variant, location, 5, iDB.MovementInReason.RESTOCK, iDB.MovementStatus.COMPLETED)
+    conn.execute("UPDATE stock_movements SET created_at = '2020-01-01 00:00:00'")
+    conn.commit()
+    iDB.compactMovements(conn, "2021-01-01 00:00:00", str(tmp_path / "archive.db"))
+
+    assert iDB.recalculatePhysicalAmount(conn, variant, location) == 15
+    assert physicalAmount(conn, variant, location) == 15
+    assert iDB.recalculateAllPhysicalAmounts(conn) == []
+
+def test_random_movements_never_drift_across_compaction(conn, tmp_path):
+    rng = random.Random(14)
+    variants, locations = addStock(conn, locations = 2, variants = 2)
+    pending = []
+    for step in range(300):
+        variant = rng.choice(variants)
+        location = rng.choice(locations)
+        if step == 150:
+            conn.execute("UPDATE stock_movements SET created_at = '2020-01-01 00:00:00'")
+            conn.commit()
+            iDB.compactMovements(conn, "2021-01-01 00:00:00", str(tmp_path / "archive.db"), chunk_size = 40)
+            assert iDB.recalculateAllPhysicalAmounts(conn) == []
+        action = rng.random()
+        if action < 0.5:
+            status = rng.choice([iDB.MovementStatus.COMPLETED, iDB.MovementStatus.PENDING])
+            iDB.addMovementIn(conn, variant, location, rng.randint(1, 20), iDB.MovementInReason.RESTOCK, status)
+            if status == iDB.MovementStatus.PENDING:
+                pending.append(lastMovementId(conn))
+        elif action < 0.6:
+            iDB.addMovementAdjust(conn, variant, location, rng.randint(0, 100), iDB.MovementAdjustReason.CORRECTION)
+        elif action < 0.9 and pending:
+            iDB.updatedMovementIn(conn, pending.pop(rng.randrange(len(pending))), iDB.MovementStatus.COMPLETED)
+        else:
+            iDB.takeStockSnapshots(conn)
+    assert iDB.recalculateAllPhysicalAmounts(conn) == []
+    conn.execute("DELETE FROM stock_snapshots")
+    assert iDB.recalculateAllPhysicalAmounts(conn) == []
+
+def test_transfer_order_completion_rechecks_source(conn):
+    (variant,), (source, destination) = addStock(conn)
+    iDB.addMovementIn(conn, variant, source, 5, iDB.MovementInReason.RESTOCK, iDB.MovementStatus.COMPLETED)
+    order_id = iDB.addTransferOrder(conn, source, destination, [(variant, 5)])
+    iDB.addMovementOut(conn, variant, source, 5, iDB.MovementOutReason.SALE, iDB.MovementStatus.COMPLETED)
+
+    with pytest.raises(iDB.InsufficientStockError):
+        iDB.updateTransferOrder(conn, order_id, iDB.MovementStatus.COMPLETED)
+    assert physicalAmount(conn, variant, source) == 0
+    iDB.updateTransferOrder(conn, order_id, iDB.MovementStatus.CANCELLED)
+    for status in (iDB.MovementStatus.COMPLETED, iDB.MovementStatus.CANCELLED):
+        with pytest.raises(ValueError):
+            iDB.updateTransferOrder(conn, order_id, status)
+
+def test_transfer_order_only_leaves_in_transit(conn):
+    (variant,), (source, destination) = addStock(conn)
+    iDB.addMovementIn(conn, variant, source, 5, iDB.MovementInReason.RESTOCK, iDB.MovementStatus.COMPLETED)
+    order_id = iDB.addTransferOrder(conn, source, destination, [(variant, 3)])
+    with pytest.raises(ValueError):
+        iDB.updateTransferOrder(conn, order_id, iDB.MovementStatus.PENDING)
+    iDB.updateTransferOrder(conn, order_id, iDB.MovementStatus.COMPLETED)
+    with pytest.raises(ValueError):
+        iDB.updateTransferOrder(conn, order_id, iDB.MovementStatus.CANCELLED)
+    assert (physicalAmount(conn, variant, source), physicalAmount(conn, variant, destination)) == (2, 3)
+
+def test_transfer_order_creation_is_validated(conn):
+    (variant,), (source, destination) = addStock(conn)
+    iDB.addMovementIn(conn, variant, source, 5, iDB.MovementInReason.RESTOCK, iDB.MovementStatus.COMPLETED)
+    for source_location, location, lines, status in ((source, destination, [], iDB.MovementStatus.IN_TRANSIT),
+                                                     (source, source, [(variant, 1)], iDB.MovementStatus.IN_TRANSIT),
+                                                     (source, destination, [(variant, 1)], iDB.MovementStatus.PENDING),
+                                                     (source, destination, [(variant, 1)], iDB.MovementStatus.CANCELLED)):
+        with pytest.raises(ValueError):
+            iDB.addTransferOrder(conn, source_location, location, lines, status = status)
+    with pytest.raises(iDB.InsufficientStockError):
+        iDB.addTransferOrder(conn, source, destination, [(variant, 6)], status = iDB.MovementStatus.COMPLETED)
+    iDB.addTransferOrder(conn, source, destination, [(variant, 5)], status = iDB.MovementStatus.COMPLETED)
+    assert (physicalAmount(conn, variant, source), physicalAmount(conn, variant, destination)) == (0, 5)
+    assert conn.execute("SELECT COUNT(*) FROM movement_orders").fetchone()[0] == 1
+
+def test_reader_connections_of_finished_threads_are_closed(tmp_path):
+    manager = iDB.ConnectionManager(str(tmp_path / "inventory.db"))
+    for _ in range(5):
+        thread = threading.Thread(target = manager.reader)
+        thread.start()
+        thread.join()
+    assert manager.readerCount() == 1
+    manager.close()